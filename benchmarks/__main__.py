@@ -0,0 +1,117 @@
+"""
+Runs the benchmark suites and writes their results as json. Given a baseline written by an
+earlier run, every shared metric is compared against it and the exit code is 1 if any of them
+regressed by more than the tolerance.
+
+    PYTHONPATH=src python -m benchmarks --output results.json
+    PYTHONPATH=src python -m benchmarks --suites datasets handlers --baseline results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+
+from benchmarks import checkpoint, dataloader, datasets, handlers, loaders, tb_logger, trainer
+
+
+SUITES: Dict[str, Callable[..., Dict[str, float]]] = {
+    'loaders': loaders.run,
+    'datasets': datasets.run,
+    'dataloader': dataloader.run,
+    'handlers': handlers.run,
+    'tb_logger': tb_logger.run,
+    'trainer': trainer.run,
+    'checkpoint': checkpoint.run,
+    }
+
+# smaller problem sizes for a fast check
+QUICK: Dict[str, Dict[str, Any]] = {
+    'loaders': {'n_shards': 16, 'repeats': 1},
+    'datasets': {'n': 256, 'combinations': ['torch,normalize', 'crop,torch,normalize']},
+    'dataloader': {'n': 1024, 'workers': [0, 2], 'epochs': 1},
+    'handlers': {'n_steps': 500},
+    'tb_logger': {'modules': ['torch_runner.handlers.tb_handler'], 'n_steps': 1000},
+    'trainer': {'n': 2048, 'hidden': 256, 'epochs': 1, 'configurations': ['fp32', 'bf16']},
+    'checkpoint': {'size_mb': 128},
+    }
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith('per_sec')
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cuda': torch.cuda.is_available(),
+        }
+
+
+def run_suites(suites: List[str], quick: bool) -> Dict[str, float]:
+    results = {}
+    for suite in suites:
+        if suite not in SUITES:
+            raise NotImplementedError(f'Benchmark suite {suite} not available')
+        print(f'Running {suite}')
+        start = time.perf_counter()
+        results.update(SUITES[suite](**(QUICK[suite] if quick else {})))
+        print(f'{suite} took {time.perf_counter() - start:.1f}s')
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[Tuple[str, float, float, float]]:
+    """
+    Returns (metric, baseline, result, relative change) for every metric that got worse by
+    more than tolerance, positive changes are always improvements.
+    """
+    regressions = []
+    for metric, reference in sorted(baseline.items()):
+        if metric not in results or reference == 0:
+            continue
+        change = (results[metric] - reference) / abs(reference)
+        if not higher_is_better(metric):
+            change = -change
+        marker = ''
+        if change < -tolerance:
+            regressions.append((metric, reference, results[metric], change))
+            marker = ' REGRESSION'
+        print(f'{metric}: {reference:.4g} -> {results[metric]:.4g} ({change:+.1%}){marker}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='torch_runner benchmark suite')
+    parser.add_argument('--suites', nargs='+', default=list(SUITES), choices=list(SUITES))
+    parser.add_argument('--quick', action='store_true', help='smaller problem sizes')
+    parser.add_argument('--output', default='', help='json file the results are written to')
+    parser.add_argument('--baseline', default='', help='json file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown per metric')
+    args = parser.parse_args()
+
+    results = run_suites(args.suites, args.quick)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} metrics regressed by more than {args.tolerance:.0%}')
+            sys.exit(1)
+        print('No regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
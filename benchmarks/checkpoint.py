@@ -0,0 +1,82 @@
+"""
+Compares restore time and memory of loading a checkpoint with a plain torch.load followed by
+load_state_dict against load_model_state, into a constructed model and onto the meta device.
+Every method runs in a fresh interpreter. max_rss_mb is the peak RSS of that interpreter (VmHWM),
+memory mapped pages count towards it but are file backed and can be dropped, peak_anon_mb is the
+anonymous memory at the peak of the load.
+
+    PYTHONPATH=src python -m benchmarks.checkpoint --size-mb 512
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+import torch
+
+
+LOAD_SNIPPET = '''
+import time, torch
+def status_mb(field):
+    with open('/proc/self/status') as f:
+        return [int(l.split()[1]) / 1024 for l in f if l.startswith(field)][0]
+from torch_runner.util.torch_utils import load_model_state
+def make_model():
+    return torch.nn.Sequential(*[torch.nn.Linear({width}, {width}) for _ in range({layers})])
+start = time.perf_counter()
+if '{method}' == 'meta':
+    with torch.device('meta'):
+        model = make_model()
+else:
+    model = make_model()
+if '{method}' == 'torch_load':
+    state_dict = torch.load('{path}')
+    model.load_state_dict(state_dict)
+else:
+    load_model_state(model, '{path}')
+# touches every weight, so lazily mapped pages are counted as well
+sum(float(p.sum()) for p in model.parameters())
+seconds = time.perf_counter() - start
+print(seconds, status_mb('RssAnon'), status_mb('VmHWM'))
+'''
+
+
+def measure_load(method: str, path: str, width: int, layers: int) -> Dict[str, float]:
+    result = subprocess.run([sys.executable, '-c', LOAD_SNIPPET.format(method=method, path=path, width=width, layers=layers)],
+            capture_output=True, text=True, env=dict(os.environ))
+    if result.returncode != 0:
+        print(result.stderr)
+        return {}
+    seconds, peak_anon, max_rss = result.stdout.split()[-3:]
+    return {'restore_sec': float(seconds), 'peak_anon_mb': float(peak_anon), 'max_rss_mb': float(max_rss)}
+
+
+def run(size_mb: int = 512, width: int = 2048, methods: List[str] = ['torch_load', 'mmap', 'meta']) -> Dict[str, float]:
+    layers = max(1, size_mb * 2**20 // (4 * width * (width + 1)))
+    model = torch.nn.Sequential(*[torch.nn.Linear(width, width) for _ in range(layers)])
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model_000')
+        torch.save(model.state_dict(), path)
+        del model
+        for method in methods:
+            for k, v in measure_load(method, path, width, layers).items():
+                results[f'checkpoint/{method}/{k}'] = v
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checkpoint restore benchmark')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--methods', nargs='+', default=['torch_load', 'mmap', 'meta'])
+    args = parser.parse_args()
+    results = run(args.size_mb, args.width, args.methods)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measures DataLoader batches/sec by worker count, with and without the batched fetch path, for a
+BasicDataSet on synthetic images from FunctionLoader.
+
+    PYTHONPATH=src python -m benchmarks.dataloader --workers 0 2 4
+"""
+import argparse
+import time
+from typing import Dict, List
+
+from torch_runner.data.base import BasicDataSet
+from torch_runner.data.generators import FunctionLoader
+from torch_runner.training_setup import build_dataloader
+from benchmarks.datasets import make_transformations, random_images
+
+
+def batches_per_sec(dataloader, epochs: int) -> float:
+    # the first batch is left out, it includes worker startup
+    n_batches = 0
+    start = None
+    for _ in range(epochs):
+        for _ in dataloader:
+            if start is None:
+                start = time.perf_counter()
+                continue
+            n_batches += 1
+    if start is None or n_batches == 0:
+        return 0.
+    return n_batches / (time.perf_counter() - start)
+
+
+def run(n: int = 4096, image_shape: List[int] = [64, 64, 3], combination: str = 'torch,normalize',
+        batch_size: int = 64, workers: List[int] = [0, 2, 4], epochs: int = 2) -> Dict[str, float]:
+    results = {}
+    dataset = BasicDataSet(FunctionLoader(random_images, {'n': n, 'image_shape': image_shape}),
+            make_transformations(combination, None))
+    for num_workers in workers:
+        for batched_fetch in [False, True]:
+            options = {'num_workers': num_workers, 'batched_fetch': batched_fetch, 'persistent_workers': num_workers > 0}
+            dataloader = build_dataloader(dataset, batch_size, True, options)
+            name = 'batched' if batched_fetch else 'per_item'
+            results[f'dataloader/workers_{num_workers}/{name}/batches_per_sec'] = batches_per_sec(dataloader, epochs)
+            del dataloader
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DataLoader worker benchmark')
+    parser.add_argument('--samples', type=int, default=4096)
+    parser.add_argument('--image-shape', type=int, nargs='+', default=[64, 64, 3])
+    parser.add_argument('--combination', default='torch,normalize')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--epochs', type=int, default=2)
+    args = parser.parse_args()
+    results = run(args.samples, args.image_shape, args.combination, args.batch_size, args.workers, args.epochs)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures items/sec of BasicDataSet and SequenceDataSet for combinations of transformations, once
+with per-item indexing and once with the batched fetch path, on synthetic images from
+FunctionLoader.
+
+    PYTHONPATH=src python -m benchmarks.datasets --combinations torch torch,normalize crop,torch
+"""
+import argparse
+import time
+from typing import Dict, List
+
+import numpy as np #type: ignore
+
+from torch_runner.data.base import BasicDataSet, SequenceDataSet
+from torch_runner.data.generators import FunctionLoader
+from torch_runner.data.transformers import TorchVisionTransformerComposition
+
+
+def random_images(n: int, image_shape: List[int]) -> np.ndarray:
+    return np.random.randint(0, 255, size=(n, *image_shape), dtype=np.uint8)
+
+
+def random_sequences(n: int, length: int, image_shape: List[int]) -> np.ndarray:
+    return np.random.randint(0, 255, size=(n, length, *image_shape), dtype=np.uint8)
+
+
+def make_transformations(combination: str, crop_shape: List[int]) -> List[TorchVisionTransformerComposition]:
+    if not combination:
+        return []
+    return [TorchVisionTransformerComposition(combination.split(','), crop_shape)]
+
+
+def items_per_sec(dataset, n_items: int, batch_size: int) -> Dict[str, float]:
+    start = time.perf_counter()
+    for i in range(n_items):
+        dataset[i]
+    per_item = n_items / (time.perf_counter() - start)
+    if hasattr(dataset, 'frame_cache'):
+        dataset.frame_cache.clear()
+    start = time.perf_counter()
+    for i in range(0, n_items, batch_size):
+        dataset.get_batch(np.arange(i, min(i + batch_size, n_items)))
+    batched = n_items / (time.perf_counter() - start)
+    return {'items_per_sec': per_item, 'batched_items_per_sec': batched}
+
+
+def run(n: int = 1024, image_shape: List[int] = [64, 64, 3], crop_shape: List[int] = [8, 8, 32, 32],
+        sequence_len: int = 8, sequence_length: int = 32, batch_size: int = 64,
+        combinations: List[str] = ['torch', 'torch,normalize', 'crop,torch,normalize', 'reshape,torch']) -> Dict[str, float]:
+    results = {}
+    for combination in combinations:
+        transformations = make_transformations(combination, crop_shape)
+        dataset = BasicDataSet(FunctionLoader(random_images, {'n': n, 'image_shape': image_shape}), transformations)
+        for k, v in items_per_sec(dataset, n, batch_size).items():
+            results[f'basic_dataset/{combination}/{k}'] = v
+        n_sequences = max(1, n // sequence_length)
+        for windowed in [False, True]:
+            dataset = SequenceDataSet(
+                    FunctionLoader(random_sequences, {'n': n_sequences, 'length': sequence_length, 'image_shape': image_shape}),
+                    transformations, sequence_len, windowed=windowed)
+            name = 'windowed' if windowed else 'plain'
+            for k, v in items_per_sec(dataset, len(dataset), batch_size).items():
+                results[f'sequence_dataset/{name}/{combination}/{k}'] = v
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dataset transformation benchmark')
+    parser.add_argument('--samples', type=int, default=1024)
+    parser.add_argument('--image-shape', type=int, nargs='+', default=[64, 64, 3])
+    parser.add_argument('--crop-shape', type=int, nargs='+', default=[8, 8, 32, 32])
+    parser.add_argument('--sequence-len', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--combinations', nargs='+', default=['torch', 'torch,normalize', 'crop,torch,normalize', 'reshape,torch'],
+            help='comma separated TorchVisionTransformerComposition transformations')
+    args = parser.parse_args()
+    results = run(args.samples, args.image_shape, args.crop_shape, args.sequence_len, batch_size=args.batch_size,
+            combinations=args.combinations)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
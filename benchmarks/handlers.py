@@ -0,0 +1,68 @@
+"""
+Measures the overhead handlers add to every training step, as microseconds spent in
+AbstractTrainer.notify_step_handlers per step, for the tensorboard and file handlers.
+
+    PYTHONPATH=src python -m benchmarks.handlers --handlers step_tb nstep_tb
+"""
+import argparse
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import torch
+
+from torch_runner.handlers.base import AbstractHandler
+from torch_runner.handlers.file_handler import NStepFileHandler, StepFileHandler
+from torch_runner.handlers.tb_handler import NStepTbHandler, StepTbHandler
+from benchmarks.trainer import BenchmarkTrainer
+
+
+HANDLERS: Dict[str, Callable[[str], AbstractHandler]] = {
+    'step_tb': lambda log_dir: StepTbHandler(logdir=log_dir, namedir='step_tb'),
+    'step_tb_async': lambda log_dir: StepTbHandler(logdir=log_dir, namedir='step_tb_async', async_logging=True),
+    'nstep_tb': lambda log_dir: NStepTbHandler(10, logdir=log_dir, namedir='nstep_tb'),
+    'step_file': lambda log_dir: StepFileHandler(log_dir, compression_method='pickle'),
+    'nstep_file_steplog': lambda log_dir: NStepFileHandler(10, log_dir, compression_method='steplog'),
+    }
+
+
+def step_data(n_tags: int) -> Dict[str, torch.Tensor]:
+    return {f'tag_{i}': torch.rand(()) for i in range(n_tags)}
+
+
+def notify_us_per_step(handler_names: List[str], n_steps: int, n_tags: int) -> float:
+    with tempfile.TemporaryDirectory() as log_dir:
+        trainer = BenchmarkTrainer()
+        for name in handler_names:
+            trainer.register_handler(HANDLERS[name](log_dir))
+        data = step_data(n_tags)
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            trainer.notify_step_handlers(data)
+        trainer.flush_handlers()
+        return (time.perf_counter() - start) / n_steps * 1e6
+
+
+def run(handlers: List[str] = list(HANDLERS), n_steps: int = 2000, n_tags: int = 4) -> Dict[str, float]:
+    results = {}
+    results['handlers/none/notify_us_per_step'] = notify_us_per_step([], n_steps, n_tags)
+    for name in handlers:
+        if name not in HANDLERS:
+            raise NotImplementedError(f'Handler {name} not available')
+        results[f'handlers/{name}/notify_us_per_step'] = notify_us_per_step([name], n_steps, n_tags)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handler overhead benchmark')
+    parser.add_argument('--handlers', nargs='+', default=list(HANDLERS))
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=4)
+    args = parser.parse_args()
+    results = run(args.handlers, args.steps, args.tags)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares shards/sec of the serial DirectoryLoader path against the process pool path.
+
+    PYTHONPATH=src python -m benchmarks.loaders --shards 64 --workers 2 4
+"""
+import argparse
+import gzip
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import dill #type: ignore
+import numpy as np #type: ignore
+
+from torch_runner.data.file_loaders import DirectoryLoader
+
+
+def write_shards(directory: str, n_shards: int, shard_shape: List[int], compression_type: str):
+    for i in range(n_shards):
+        shard = np.random.randint(0, 255, size=shard_shape, dtype=np.uint8)
+        path = os.path.join(directory, 'shard_{:05d}'.format(i))
+        if compression_type == 'gzip':
+            with gzip.open(path, 'wb') as f:
+                dill.dump(shard, f)
+        else:
+            with open(path, 'wb') as f:
+                dill.dump(shard, f)
+
+
+def time_loader(directory: str, compression_type: str, num_workers: int, repeats: int) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        loader = DirectoryLoader(directory, compression_type=compression_type, num_workers=num_workers)
+        start = time.perf_counter()
+        loader.get_dataset()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(n_shards: int = 64, shard_shape: List[int] = [64, 64, 64, 3], compression_type: str = 'gzip',
+        workers: List[int] = [2, 4], repeats: int = 3) -> Dict[str, float]:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_shards(directory, n_shards, shard_shape, compression_type)
+        for num_workers in [0] + list(workers):
+            elapsed = time_loader(directory, compression_type, num_workers, repeats)
+            results[f'directory_loader/workers_{num_workers}/shards_per_sec'] = n_shards / elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DirectoryLoader decoding benchmark')
+    parser.add_argument('--shards', type=int, default=64)
+    parser.add_argument('--shard-shape', type=int, nargs='+', default=[64, 64, 64, 3])
+    parser.add_argument('--compression-type', default='gzip')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    results = run(args.shards, args.shard_shape, args.compression_type, args.workers, args.repeats)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures import time and peak RSS of the logging path in a fresh interpreter, and the scalar
+write throughput of Logger. tensorflow is measured as well when it is installed, as reference
+for the previous tensorflow based Logger.
+
+    PYTHONPATH=src python -m benchmarks.tb_logger
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from torch_runner.util.tf_logger import Logger
+
+
+# ru_maxrss of a child still carries the high-water mark of the forking parent on Linux, VmHWM is
+# the peak of the process itself
+IMPORT_SNIPPET = '''
+import time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+with open('/proc/self/status') as f:
+    print(seconds, [l.split()[1] for l in f if l.startswith('VmHWM')][0])
+'''
+
+
+def measure_import(module: str) -> Dict[str, float]:
+    result = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)],
+            capture_output=True, text=True, env=dict(os.environ))
+    if result.returncode != 0:
+        return {}
+    seconds, max_rss = result.stdout.split()[-2:]
+    return {'import_sec': float(seconds), 'max_rss_mb': int(max_rss) / 1024}
+
+
+def measure_scalar_writes(n_steps: int, n_tags: int) -> float:
+    with tempfile.TemporaryDirectory() as log_dir:
+        logger = Logger(log_dir)
+        values = {f'tag_{i}': float(i) for i in range(n_tags)}
+        start = time.perf_counter()
+        for step in range(n_steps):
+            logger.scalars_summary(values, step)
+        logger.flush()
+        return n_steps * n_tags / (time.perf_counter() - start)
+
+
+def run(modules: List[str] = ['torch', 'torch_runner.handlers.tb_handler', 'tensorflow'],
+        n_steps: int = 10000, n_tags: int = 8) -> Dict[str, float]:
+    results = {}
+    for module in modules:
+        for k, v in measure_import(module).items():
+            results[f'import/{module}/{k}'] = v
+    results['logger/scalars_per_sec'] = measure_scalar_writes(n_steps, n_tags)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging import and write benchmark')
+    parser.add_argument('--steps', type=int, default=10000)
+    parser.add_argument('--tags', type=int, default=8)
+    args = parser.parse_args()
+    for k, v in run(n_steps=args.steps, n_tags=args.tags).items():
+        print(f'{k}: {v:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares steps/sec of AbstractTrainer.train on the cpu for the fp32 path against bf16 autocast
+and gradient accumulation, on synthetic data from FunctionLoader.
+
+    PYTHONPATH=src python -m benchmarks.trainer
+"""
+import argparse
+import time
+from typing import Dict, List
+
+import numpy as np #type: ignore
+import torch
+
+from torch_runner.data.base import BasicDataSet
+from torch_runner.data.generators import FunctionLoader
+from torch_runner.train.base import AbstractTrainer
+from torch_runner.training_setup import build_dataloader
+
+
+def random_vectors(n: int, dim: int) -> np.ndarray:
+    return np.random.randn(n, dim).astype(np.float32)
+
+
+def make_model(dim: int, hidden: int) -> torch.nn.Module:
+    return torch.nn.Sequential(
+            torch.nn.Linear(dim, hidden),
+            torch.nn.ReLU(),
+            torch.nn.Linear(hidden, hidden),
+            torch.nn.ReLU(),
+            torch.nn.Linear(hidden, dim))
+
+
+class BenchmarkTrainer(AbstractTrainer):
+
+    def train_step(self, data, **kwargs) -> Dict:
+        with self.autocast():
+            loss = torch.nn.functional.mse_loss(self.model(data).float(), data)
+        self.optimization_step(loss)
+        return {'loss': loss.detach()}
+
+    def check_ready(self) -> bool:
+        return True
+
+
+def make_trainer(n: int, dim: int, hidden: int, batch_size: int, precision: str = 'fp32',
+        accumulation_steps: int = 1) -> BenchmarkTrainer:
+    dataset = BasicDataSet(FunctionLoader(random_vectors, {'n': n, 'dim': dim}), [])
+    trainer = BenchmarkTrainer()
+    trainer.register_model(make_model(dim, hidden))
+    trainer.register_device('cpu')
+    trainer.register_optimizer(torch.optim.Adam, 1e-3)
+    trainer.configure_optimization(precision, accumulation_steps)
+    trainer.add_train_dataloader(build_dataloader(dataset, batch_size, True))
+    return trainer
+
+
+def steps_per_sec(trainer: AbstractTrainer, epochs: int) -> float:
+    trainer.train(1, train_only=True)
+    start = time.perf_counter()
+    trainer.train(trainer.epoch + epochs, train_only=True)
+    return epochs * len(trainer.train_dataloader) / (time.perf_counter() - start)
+
+
+def run(n: int = 8192, dim: int = 256, hidden: int = 1024, batch_size: int = 64, epochs: int = 2,
+        configurations: List[str] = ['fp32', 'bf16', 'fp32:4', 'bf16:4']) -> Dict[str, float]:
+    results = {}
+    for configuration in configurations:
+        precision, _, accumulation = configuration.partition(':')
+        trainer = make_trainer(n, dim, hidden, batch_size, precision, int(accumulation or 1))
+        results[f'trainer/{precision}/accumulation_{accumulation or 1}/steps_per_sec'] = steps_per_sec(trainer, epochs)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Training step benchmark')
+    parser.add_argument('--samples', type=int, default=8192)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--hidden', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--configurations', nargs='+', default=['fp32', 'bf16', 'fp32:4', 'bf16:4'],
+            help='precision, optionally followed by :accumulation_steps')
+    args = parser.parse_args()
+    results = run(args.samples, args.dim, args.hidden, args.batch_size, args.epochs, args.configurations)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}')
+
+
+if __name__ == '__main__':
+    main()
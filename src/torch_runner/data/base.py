@@ -1,17 +1,84 @@
+import copy
+import itertools
+import random
 from abc import ABC, abstractmethod
-from typing import List, Union, Optional, Generic, TypeVar
+from typing import List, Dict, Tuple, Union, Optional, Generic, TypeVar, Iterator
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
 import numpy as np #type: ignore
 
 from torch_runner.util.data_util import DataLoaderType
-from .transformers import DataTransformation, TypeTransformer
+from .transformers import DataTransformation, TypeTransformer, stack_samples
+from .cache import TransformCache
 
 
 LoadedData = TypeVar('LoadedData')
 ProvidedData = TypeVar('ProvidedData')
+Index = Union[int, List[int], np.ndarray, torch.Tensor]
+
+
+def is_batch_index(idx: Index) -> bool:
+    return isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)) and np.ndim(idx) > 0
+
+
+def gather(data, indices: np.ndarray):
+    """
+    Fetches all indices with a single fancy indexing call where the data supports it.
+    """
+    if hasattr(data, 'shape'):
+        return data[indices]
+    return stack_samples([data[i] for i in indices])
+
+
+def split_batch(batch) -> List:
+    if isinstance(batch, dict):
+        n = len(next(iter(batch.values())))
+        return [{k: v[i] for k, v in batch.items()} for i in range(n)]
+    return list(batch)
+
+
+def setup_transformations(transformations: List[DataTransformation], loader_type: Optional[str]) -> Tuple[List[DataTransformation], str]:
+    """
+    Builds the per-sample transformation chain and the device the data is meant for. Transfers to
+    cuda are not done per sample, the trainer moves whole batches to the returned device.
+    """
+    chain: List[DataTransformation] = []
+    for t in transformations:
+        chain.append(t)
+    if loader_type == 'cuda':
+        return chain, 'cuda'
+    if loader_type:
+        chain.append(TypeTransformer(loader_type))
+    return chain, 'cpu'
+
+
+def apply_transformations(datum, transformations: List[DataTransformation]):
+    for transformation in transformations:
+        datum = transformation.transform(datum)
+    return datum
+
+
+def apply_batch_transformations(data, transformations: List[DataTransformation], batch_ndim: int = 1):
+    for transformation in transformations:
+        data = transformation.transform_batch(data, batch_ndim)
+    return data
+
+
+def transform_sequence(sequence, transformations: List[DataTransformation]) -> torch.Tensor:
+    frames = apply_batch_transformations(sequence, transformations)
+    if not isinstance(frames, torch.Tensor):
+        frames = torch.from_numpy(np.array(frames))
+    return frames
+
+
+def sliding_windows(frames: torch.Tensor, sequence_len: int, n_windows: int) -> torch.Tensor:
+    """
+    Returns a (n_windows, sequence_len, ...) strided view over frames without copying.
+    """
+    return frames.unfold(0, sequence_len, 1)[:n_windows].movedim(-1, 1)
+
 
 class DataSource(Generic[LoadedData, ProvidedData], ABC):
 
@@ -25,14 +92,16 @@ class DataSource(Generic[LoadedData, ProvidedData], ABC):
 
 class BasicDataSet(Dataset):
 
-    def __init__(self, source_loader: DataSource, transformations: List[DataTransformation], loader_type: Optional[str] = ''):
+    # whether DataLoaders fetch through get_batch, set by training_setup.build_dataloader
+    batched_fetch = True
+
+    def __init__(self, source_loader: DataSource, transformations: List[DataTransformation], loader_type: Optional[str] = '', cache: Optional[TransformCache] = None):
         self.dataset = source_loader.get_dataset()
         self.n = len(self.dataset)
-        self.transformations: List[DataTransformation] = []
-        for t in transformations:
-            self.transformations.append(t)
-        if loader_type:
-            self.transformations.append(TypeTransformer(loader_type))
+        self.transformations, self.device = setup_transformations(transformations, loader_type)
+        self.cache = cache
+        if self.cache is not None:
+            self.cache.bind(self.n, self.transform_index(0))
     
     def __iter__(self):
         for i in range(len(self)):
@@ -41,11 +110,39 @@ class BasicDataSet(Dataset):
     def __len__(self):
         return len(self.dataset)        
 
-    def __getitem__(self, idx: int) -> Union[np.ndarray, torch.Tensor]:
-        datum = self.dataset[idx]
-        for transformation in self.transformations:
-            datum = transformation.transform(datum)
-        return datum
+    def __getitem__(self, idx: Index) -> Union[np.ndarray, torch.Tensor]:
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        if self.cache is not None:
+            return self.cache.get_or_compute(int(idx), self.transform_index)
+        return self.transform_index(idx)
+
+    def transform_index(self, idx: int) -> Union[np.ndarray, torch.Tensor]:
+        return apply_transformations(self.dataset[idx], self.transformations)
+
+    def __getitems__(self, indices: List[int]) -> List:
+        if not self.batched_fetch:
+            return [self[i] for i in indices]
+        return split_batch(self.get_batch(indices))
+
+    def get_batch(self, indices: Index) -> Union[np.ndarray, torch.Tensor]:
+        """
+        Fetches and transforms a whole batch at once, the result is already collated.
+        """
+        indices = np.asarray(indices)
+        if self.cache is not None:
+            return self.get_cached_batch(indices)
+        return apply_batch_transformations(gather(self.dataset, indices), self.transformations)
+
+    def get_cached_batch(self, indices: np.ndarray) -> Union[np.ndarray, torch.Tensor]:
+        batch = [self.cache.get(int(i)) for i in indices]
+        missing = [j for j, datum in enumerate(batch) if datum is None]
+        if missing:
+            computed = apply_batch_transformations(gather(self.dataset, indices[missing]), self.transformations)
+            for j, datum in zip(missing, computed):
+                self.cache.put(int(indices[j]), datum)
+                batch[j] = datum
+        return stack_samples(batch)
     
     def get_all(self):
         for datum in self:
@@ -54,15 +151,25 @@ class BasicDataSet(Dataset):
 
 class SequenceDataSet(Dataset):
 
-    def __init__(self, source_loader: DataSource, transformations: List[DataTransformation], sequence_len:int, loader_type: Optional[str] = ''):
+    # a batch transforms batch_size * sequence_len frames at once, which is slower than per item
+    batched_fetch = False
+
+    def __init__(self, source_loader: DataSource, transformations: List[DataTransformation], sequence_len:int, loader_type: Optional[str] = '',
+            windowed: bool = False, cache_bytes: int = 2**30):
+        """
+        With windowed set, every frame is transformed once per sequence and cached, windows are
+        returned as views into the cache. Only use this with deterministic transformations.
+        The cache keeps the least recently used sequences up to cache_bytes. Each DataLoader worker
+        starts with an empty cache of its own, so with workers it takes up to num_workers times
+        cache_bytes, and windows of a sequence are only transformed once if they are drawn by the
+        same worker.
+        """
         self.dataset = source_loader.get_dataset()
         self.n = len(self.dataset)
-        self.transformations: List[DataTransformation] = []
         self.sequence_len = sequence_len
-        for t in transformations:
-            self.transformations.append(t)
-        if loader_type:
-            self.transformations.append(TypeTransformer(loader_type))
+        self.windowed = windowed
+        self.frame_cache = TransformCache(cache_bytes)
+        self.transformations, self.device = setup_transformations(transformations, loader_type)
     
     def __iter__(self):
         for i in range(len(self)):
@@ -71,16 +178,35 @@ class SequenceDataSet(Dataset):
     def __len__(self):
         return (self.dataset.shape[1] - self.sequence_len) * self.dataset.shape[0]
 
-    def __getitem__(self, idx: int) -> Union[np.ndarray, torch.Tensor]:
+    def __getitem__(self, idx: Index) -> Union[np.ndarray, torch.Tensor]:
+        if is_batch_index(idx):
+            return self.get_batch(idx)
         seq = idx //(self.dataset.shape[1] - self.sequence_len)
         idx = idx % (self.dataset.shape[1] - self.sequence_len)
+        if self.windowed:
+            return self.get_frames(seq)[idx:idx+self.sequence_len]
         datum = self.dataset[seq, idx:idx+self.sequence_len]
-        imgs = []
-        for img in datum:
-            for transformation in self.transformations:
-                img = transformation.transform(img)
-            imgs.append(img)
-        return torch.stack(imgs, 0)
+        return apply_batch_transformations(datum, self.transformations)
+
+    def get_frames(self, seq: int) -> torch.Tensor:
+        return self.frame_cache.get_or_compute(int(seq), lambda s: transform_sequence(self.dataset[s], self.transformations))
+
+    def get_windows(self, seq: int) -> torch.Tensor:
+        return sliding_windows(self.get_frames(seq), self.sequence_len, self.dataset.shape[1] - self.sequence_len)
+
+    def __getitems__(self, indices: List[int]) -> List:
+        if not self.batched_fetch:
+            return [self[i] for i in indices]
+        return split_batch(self.get_batch(indices))
+
+    def get_batch(self, indices: Index) -> Union[np.ndarray, torch.Tensor]:
+        indices = np.asarray(indices)
+        seq = indices // (self.dataset.shape[1] - self.sequence_len)
+        idx = indices % (self.dataset.shape[1] - self.sequence_len)
+        if self.windowed:
+            return torch.stack([self.get_frames(s)[i:i+self.sequence_len] for s, i in zip(seq, idx)], 0)
+        frames = idx[:, None] + np.arange(self.sequence_len)[None]
+        return apply_batch_transformations(self.dataset[seq[:, None], frames], self.transformations, 2)
 
     def get_all(self):
         for idx in range(self.__len__()):
@@ -90,20 +216,27 @@ class SequenceDataSet(Dataset):
 
 class SequenceDictDataSet(Dataset):
 
+    batched_fetch = False
+
     def __init__(self,
             source_loader: DataSource,
             transformations: List[DataTransformation],
             sequence_len:int,
-            loader_type: Optional[str] = ''):
+            loader_type: Optional[str] = '',
+            windowed: bool = False,
+            cache_bytes: int = 2**30):
+        """
+        Windowed mode caches the transformed 'X' frames as in SequenceDataSet, within cache_bytes
+        per process. Auxiliary keys are not transformed and are always returned as views into the
+        source arrays.
+        """
         self.dataset = source_loader.get_dataset()
         assert 'X' in self.dataset.keys(), 'Need a primary data entry'
         self.n = len(self.dataset['X'])
-        self.transformations: List[DataTransformation] = []
         self.sequence_len = sequence_len
-        for t in transformations:
-            self.transformations.append(t)
-        if loader_type:
-            self.transformations.append(TypeTransformer(loader_type))
+        self.windowed = windowed
+        self.frame_cache = TransformCache(cache_bytes)
+        self.transformations, self.device = setup_transformations(transformations, loader_type)
     
     def __iter__(self):
         for i in range(len(self)):
@@ -113,25 +246,132 @@ class SequenceDictDataSet(Dataset):
         l = (self.dataset['X'].shape[1] - self.sequence_len) * self.dataset['X'].shape[0]
         return l
 
-    def __getitem__(self, idx: int) -> Union[np.ndarray, torch.Tensor]:
+    def __getitem__(self, idx: Index) -> Dict[str, Union[np.ndarray, torch.Tensor]]:
+        if is_batch_index(idx):
+            return self.get_batch(idx)
         seq = idx //(self.dataset['X'].shape[1] - self.sequence_len)
         idx = idx % (self.dataset['X'].shape[1] - self.sequence_len)
         datum = {}
         for k in self.dataset:
-            if 'X' == k:
-                imgs = []
-                for img in self.dataset[k][seq][idx:idx+self.sequence_len]:
-                    for transformation in self.transformations:
-                        img = transformation.transform(img)
-                    imgs.append(img)
-                datum[k] = torch.stack(imgs, 0)
+            if 'X' == k and self.windowed:
+                datum[k] = self.get_frames(seq)[idx:idx+self.sequence_len]
+            elif 'X' == k:
+                datum[k] = apply_batch_transformations(self.dataset[k][seq][idx:idx+self.sequence_len], self.transformations)
             else:
                 if not hasattr(self.dataset[k], 'shape'):
                     continue
                 datum[k] = self.dataset[k][seq][idx:idx+self.sequence_len]
         return datum
 
+    def get_frames(self, seq: int) -> torch.Tensor:
+        return self.frame_cache.get_or_compute(int(seq), lambda s: transform_sequence(self.dataset['X'][s], self.transformations))
+
+    def get_windows(self, seq: int) -> Dict[str, Union[np.ndarray, torch.Tensor]]:
+        n_windows = self.dataset['X'].shape[1] - self.sequence_len
+        windows = {}
+        for k in self.dataset:
+            if 'X' == k:
+                windows[k] = sliding_windows(self.get_frames(seq), self.sequence_len, n_windows)
+            elif hasattr(self.dataset[k], 'shape'):
+                aux = np.lib.stride_tricks.sliding_window_view(self.dataset[k][seq], self.sequence_len, axis=0)
+                windows[k] = np.moveaxis(aux[:n_windows], -1, 1)
+        return windows
+
+    def __getitems__(self, indices: List[int]) -> List:
+        if not self.batched_fetch:
+            return [self[i] for i in indices]
+        return split_batch(self.get_batch(indices))
+
+    def get_batch(self, indices: Index) -> Dict[str, Union[np.ndarray, torch.Tensor]]:
+        indices = np.asarray(indices)
+        seq = indices // (self.dataset['X'].shape[1] - self.sequence_len)
+        idx = indices % (self.dataset['X'].shape[1] - self.sequence_len)
+        frames = idx[:, None] + np.arange(self.sequence_len)[None]
+        batch = {}
+        for k in self.dataset:
+            if 'X' == k and self.windowed:
+                batch[k] = torch.stack([self.get_frames(s)[i:i+self.sequence_len] for s, i in zip(seq, idx)], 0)
+            elif 'X' == k:
+                batch[k] = apply_batch_transformations(self.dataset[k][seq[:, None], frames], self.transformations, 2)
+            elif hasattr(self.dataset[k], 'shape'):
+                batch[k] = self.dataset[k][seq[:, None], frames]
+        return batch
+
     def get_all(self):
         for seq in self:
             for item in seq['X']:
                 yield item
+
+
+class StreamingDataSet(IterableDataset):
+
+    def __init__(self, source_loader: DataSource, transformations: List[DataTransformation], loader_type: Optional[str] = '',
+            shuffle_buffer: int = 0, seed: Optional[int] = None):
+        """
+        Streams samples from a source with iter_shard, e.g. a StreamingFunctionLoader, and
+        transforms them on the fly. Every DataLoader worker of every distributed process
+        generates its own shard with its own seed, which changes every epoch unless seed is set.
+        shuffle_buffer > 0 shuffles within a buffer of that many samples.
+        """
+        self.source_loader = source_loader
+        self.transformations, self.device = setup_transformations(transformations, loader_type)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.batch_size: Optional[int] = None
+        self.drop_last = False
+
+    def batched(self, batch_size: int, drop_last: bool = False) -> 'StreamingDataSet':
+        """
+        A view of the stream which yields collated batches, transformed with the batched path.
+        """
+        stream = copy.copy(self)
+        stream.batch_size = batch_size
+        stream.drop_last = drop_last
+        return stream
+
+    def shard(self) -> Tuple[int, int, int]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        shard = rank * num_workers + worker_id
+        if self.seed is not None:
+            seed = self.seed + shard
+        elif worker_info is not None:
+            # differs per worker and epoch
+            seed = worker_info.seed + rank * num_workers
+        else:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item()) + shard
+        if worker_info is not None:
+            # DataLoader seeds torch and random in workers, but not numpy
+            np.random.seed(seed % 2**32)
+        return shard, num_workers * world_size, seed
+
+    def shuffled(self, samples: Iterator, seed: int) -> Iterator:
+        rng = random.Random(seed)
+        buffer: List = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            j = rng.randrange(self.shuffle_buffer)
+            yield buffer[j]
+            buffer[j] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator:
+        shard, n_shards, seed = self.shard()
+        samples = self.source_loader.iter_shard(shard, n_shards, seed) #type: ignore
+        if self.shuffle_buffer > 0:
+            samples = self.shuffled(samples, seed)
+        if self.batch_size is None:
+            for sample in samples:
+                yield apply_transformations(sample, self.transformations)
+            return
+        while True:
+            batch = list(itertools.islice(samples, self.batch_size))
+            if not batch or (self.drop_last and len(batch) < self.batch_size):
+                return
+            yield apply_batch_transformations(stack_samples(batch), self.transformations)
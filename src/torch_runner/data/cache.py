@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np #type: ignore
+import torch
+
+
+def n_bytes(datum) -> int:
+    if isinstance(datum, torch.Tensor):
+        return datum.element_size() * datum.nelement()
+    return np.asarray(datum).nbytes
+
+
+class TransformCache():
+    """
+    Caches the output of a dataset's transformation chain keyed on the sample index. Results are
+    kept in RAM up to max_bytes with LRU eviction. If spill_path is given, every result is also
+    written to a memory-mapped file which all processes opening the cache share, so DataLoader
+    workers reuse each other's work. Only use this with deterministic transformations.
+    """
+
+    def __init__(self, max_bytes: int = 2**30, spill_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.entries: 'OrderedDict[int, Any]' = OrderedDict()
+        self.cached_bytes = 0
+        # hits and misses, in shared memory so the counts of all workers add up
+        self.counters = torch.zeros(2, dtype=torch.int64).share_memory_()
+        self.spill: Optional[np.memmap] = None
+        self.spill_filled: Optional[np.memmap] = None
+        self.spill_layout: Optional[Dict[str, Any]] = None
+
+    def bind(self, n: int, sample):
+        """
+        Called once by the owning dataset with its length and a transformed sample, creates the
+        spill file before any worker processes are started.
+        """
+        if self.spill_path is None:
+            return
+        sample_array = sample.cpu().numpy() if isinstance(sample, torch.Tensor) else np.asarray(sample)
+        self.spill_layout = {
+                'shape': (n,) + sample_array.shape,
+                'dtype': sample_array.dtype,
+                'tensor': isinstance(sample, torch.Tensor),
+                }
+        self.open_spill('w+')
+
+    def open_spill(self, mode: str):
+        layout = self.spill_layout
+        self.spill = np.memmap(self.spill_path, dtype=layout['dtype'], mode=mode, shape=layout['shape'])
+        self.spill_filled = np.memmap(self.spill_path + '.filled', dtype=np.uint8, mode=mode, shape=layout['shape'][:1])
+
+    def __getstate__(self):
+        # memory maps and cached entries are not sent to worker processes, workers reopen the spill file
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['cached_bytes'] = 0
+        state['spill'] = None
+        state['spill_filled'] = None
+        return state
+
+    def get(self, idx: int):
+        if idx in self.entries:
+            self.entries.move_to_end(idx)
+            self.counters[0] += 1
+            return self.entries[idx]
+        if self.spill_layout is not None:
+            if self.spill is None:
+                self.open_spill('r+')
+            if self.spill_filled[idx]:
+                datum = np.array(self.spill[idx])
+                if self.spill_layout['tensor']:
+                    datum = torch.from_numpy(datum)
+                self.counters[0] += 1
+                self.insert(idx, datum)
+                return datum
+        self.counters[1] += 1
+        return None
+
+    def put(self, idx: int, datum):
+        self.insert(idx, datum)
+        if self.spill_layout is not None:
+            if self.spill is None:
+                self.open_spill('r+')
+            self.spill[idx] = datum.cpu().numpy() if isinstance(datum, torch.Tensor) else datum
+            self.spill_filled[idx] = 1
+
+    def insert(self, idx: int, datum):
+        size = n_bytes(datum)
+        if size > self.max_bytes:
+            return
+        self.entries[idx] = datum
+        self.cached_bytes += size
+        while self.cached_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.cached_bytes -= n_bytes(evicted)
+
+    def clear(self):
+        """Empties the in-memory entries, the spill file is kept."""
+        self.entries.clear()
+        self.cached_bytes = 0
+
+    def get_or_compute(self, idx: int, compute: Callable[[int], Any]):
+        datum = self.get(idx)
+        if datum is None:
+            datum = compute(idx)
+            self.put(idx, datum)
+        return datum
+
+    def stats(self) -> Dict[str, int]:
+        return {
+                'hits': int(self.counters[0]),
+                'misses': int(self.counters[1]),
+                'entries': len(self.entries),
+                'bytes': self.cached_bytes,
+                }
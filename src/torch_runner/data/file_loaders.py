@@ -1,8 +1,13 @@
 import os
+import json
 import gzip #type: ignore
 import dill #type: ignore
+import multiprocessing as mp
 import pickle
-from typing import Iterable, Callable, TypeVar, Generic
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Callable, TypeVar, Generic, List, Optional
 from abc import ABC, abstractmethod
 
 import numpy as np #type: ignore
@@ -10,30 +15,121 @@ import numpy as np #type: ignore
 from .base import DataSource, LoadedData, ProvidedData
 
 
+MEMMAP_DATA_FILE = 'data.bin'
+MEMMAP_INDEX_FILE = 'index.json'
+
+
+def load_file(file_name: str, compression_type: str = 'pickle') -> LoadedData:
+    if compression_type == 'gzip':
+        with gzip.open(file_name, 'rb') as f:
+            return dill.load(f)
+    elif compression_type == 'pickle':
+        with open(file_name, 'rb') as f:
+            return pickle.load(f)
+    raise NotImplementedError(f'Compression type {compression_type} not available')
+
+
 class DirectoryLoader(DataSource):
     def __init__(self, directory: str = '', 
             compression_type: str = 'pickle', 
             preprocess_function: Callable[[LoadedData], LoadedData] = lambda x: x,
+            num_workers: int = 0,
+            streaming: bool = False,
             **kwargs):
         self.directory = directory
         self.filenames = os.listdir(directory)
         self.compression_type = compression_type
         self.preprocess_function = preprocess_function
+        self.num_workers = num_workers
+        self.streaming = streaming
+
+    def iter_shards(self, filenames: Optional[List[str]] = None) -> Iterator[LoadedData]:
+        """
+        Yields the preprocessed shards of filenames, by default of all files, in file order. With
+        num_workers > 0 the shards are decoded in a process pool, keeping at most two shards per
+        worker in flight.
+        """
+        paths = [os.path.join(self.directory, f) for f in (self.filenames if filenames is None else filenames)]
+        # DataLoader workers are daemonic and cannot start a pool
+        if self.num_workers <= 0 or mp.current_process().daemon:
+            for path in paths:
+                yield self.preprocess_function(load_file(path, self.compression_type))
+            return
+        with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+            pending: deque = deque()
+            for path in paths:
+                pending.append(pool.submit(load_file, path, self.compression_type))
+                if len(pending) >= 2 * self.num_workers:
+                    yield self.preprocess_function(pending.popleft().result())
+            while pending:
+                yield self.preprocess_function(pending.popleft().result())
+
+    def iter_shard(self, shard: int, n_shards: int, seed: Optional[int]) -> Iterator:
+        """
+        Yields the samples of every n_shards-th file starting at shard, so StreamingDataSet splits
+        the files between its workers. A seed shuffles the order of the files.
+        """
+        filenames = self.filenames[shard::n_shards]
+        if seed is not None:
+            random.Random(seed).shuffle(filenames)
+        for data in self.iter_shards(filenames):
+            yield from data
 
     def get_dataset(self) -> ProvidedData:
-        dataset = []
+        if self.streaming:
+            return self.iter_shard(0, 1, None)
+        return np.concatenate(list(self.iter_shards()), 0)
 
-        for imgfile in self.filenames:
-            imgpath = os.path.join(self.directory, imgfile)
-            if self.compression_type == 'gzip':
-                with gzip.open(imgpath, 'rb') as f:
-                    img = self.preprocess_function(dill.load(f))
-                dataset.append(img)
-            elif self.compression_type == 'pickle':
-                with open(imgpath, 'rb') as f:
-                    img = self.preprocess_function(pickle.load(f))
-                dataset.append(img)
-        return np.concatenate(dataset, 0)
+    def convert_to_memmap(self, out_dir: str) -> str:
+        """
+        Writes all shards once into a single raw buffer in out_dir, together with an index file
+        describing its layout. Only one shard is held in memory at a time. The result can be
+        opened with MemmapLoader.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        dtype = None
+        item_shape = None
+        shards = []
+        n = 0
+        with open(os.path.join(out_dir, MEMMAP_DATA_FILE), 'wb') as f:
+            for imgfile, shard in zip(self.filenames, self.iter_shards()):
+                shard = np.ascontiguousarray(shard)
+                if dtype is None:
+                    dtype, item_shape = shard.dtype, shard.shape[1:]
+                elif shard.dtype != dtype or shard.shape[1:] != item_shape:
+                    raise ValueError(f'Shard {imgfile} does not match layout {dtype}{item_shape}')
+                shard.tofile(f)
+                shards.append({'file': imgfile, 'start': n, 'length': len(shard)})
+                n += len(shard)
+        if dtype is None:
+            raise ValueError(f'No shards found in {self.directory}')
+        index = {
+            'dtype': np.dtype(dtype).str,
+            'shape': [n] + list(item_shape),
+            'shards': shards,
+            }
+        with open(os.path.join(out_dir, MEMMAP_INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        return out_dir
+
+
+class MemmapLoader(DataSource):
+    """
+    Opens a directory written by DirectoryLoader.convert_to_memmap. The dataset is returned as a
+    read-only np.memmap, so datasets index straight into the file pages.
+    """
+    def __init__(self, directory: str = '', mode: str = 'r', **kwargs):
+        self.directory = directory
+        self.mode = mode
+        with open(os.path.join(directory, MEMMAP_INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+
+    def get_dataset(self) -> ProvidedData:
+        return np.memmap(
+                os.path.join(self.directory, MEMMAP_DATA_FILE),
+                dtype=np.dtype(self.index['dtype']),
+                mode=self.mode,
+                shape=tuple(self.index['shape']))
 
 
 class FileLoader(DataSource):
@@ -46,10 +142,4 @@ class FileLoader(DataSource):
         self.preprocess_function = preprocess_function
 
     def get_dataset(self):
-        if self.compression_type == 'gzip':
-            with gzip.open(self.file_name, 'rb') as f:
-                dataset = self.preprocess_function(dill.load(f))
-        elif self.compression_type == 'pickle':
-            with open(self.file_name, 'rb') as f:
-                dataset = self.preprocess_function(pickle.load(f))
-        return dataset
+        return self.preprocess_function(load_file(self.file_name, self.compression_type))
@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Iterator, Optional
 
 from .base import DataSource, LoadedData
 
@@ -14,3 +14,36 @@ class FunctionLoader(DataSource):
 
     def get_dataset(self):
         return self.preprocessing_function(self.generator_function(**self.generator_function_args))
+
+
+class StreamingFunctionLoader(DataSource):
+    """
+    Consumes the iterable returned by generator_function lazily instead of materializing it.
+    Generation can be split into shards, e.g. one per DataLoader worker: every shard calls
+    generator_function with its own seed passed as seed_argument, and if shard_argument is
+    set, that argument (e.g. the number of samples) is divided between the shards.
+    """
+    def __init__(self, generator_function,
+            generator_function_args,
+            preprocessing_function: Callable[[LoadedData], LoadedData] = lambda x: x,
+            seed_argument: Optional[str] = None,
+            shard_argument: Optional[str] = None,
+            **kwargs):
+        self.generator_function = generator_function
+        self.preprocessing_function = preprocessing_function
+        self.generator_function_args = generator_function_args
+        self.seed_argument = seed_argument
+        self.shard_argument = shard_argument
+
+    def get_dataset(self) -> Iterator:
+        return self.iter_shard(0, 1, None)
+
+    def iter_shard(self, shard: int, n_shards: int, seed: Optional[int]) -> Iterator:
+        args = dict(self.generator_function_args)
+        if self.seed_argument is not None and seed is not None:
+            args[self.seed_argument] = seed
+        if self.shard_argument is not None:
+            total = args[self.shard_argument]
+            args[self.shard_argument] = total // n_shards + (1 if shard < total % n_shards else 0)
+        for datum in self.generator_function(**args):
+            yield self.preprocessing_function(datum)
@@ -0,0 +1,47 @@
+import itertools
+from typing import Any, Dict, Iterator, Optional
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """
+    Wraps a sampler so an epoch can be resumed part way through. Every epoch is deterministic
+    given seed: a wrapped RandomSampler draws from a generator seeded with seed + epoch, a
+    DistributedSampler gets the epoch through set_epoch. Without set_epoch, every iteration
+    counts as the next epoch. skip(n) leaves out the first n indices of the next iteration.
+    """
+
+    def __init__(self, sampler: Sampler, seed: Optional[int] = None):
+        self.sampler = sampler
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def skip(self, n: int):
+        self.start = n
+
+    def __iter__(self) -> Iterator:
+        epoch = self.epoch
+        self.epoch += 1
+        if hasattr(self.sampler, 'generator'):
+            self.sampler.generator = torch.Generator().manual_seed(self.seed + epoch)
+        start, self.start = self.start, 0
+        return itertools.islice(iter(self.sampler), start, None)
+
+    def __len__(self) -> int:
+        return len(self.sampler) #type: ignore
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {'seed': self.seed}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.seed = state['seed']
@@ -1,27 +1,86 @@
 from abc import ABC, abstractmethod
 from typing import List, Iterable, Dict, Optional, Any
 
+import numpy as np #type: ignore
+import torch
+import torch.nn.functional as F
 from torchvision.transforms import transforms #type: ignore
+from torchvision.transforms import functional as tv_functional #type: ignore
 from PIL import Image #type: ignore
 
 
+def stack_samples(samples: List[Any]):
+    if isinstance(samples[0], torch.Tensor):
+        return torch.stack(samples, 0)
+    return torch.as_tensor(np.stack([np.asarray(s) for s in samples], 0))
+
+
 class DataTransformation(ABC):
 
     @abstractmethod
     def transform(self, data):
         pass
 
+    def transform_batch(self, data, batch_ndim: int = 1):
+        """
+        Transforms a block of shape (*batch, *sample) with batch_ndim leading batch dimensions at
+        once. The default falls back to transforming each sample separately, subclasses override
+        it with tensor ops.
+        """
+        batch_shape = data.shape[:batch_ndim]
+        flat = data.reshape(-1, *data.shape[batch_ndim:])
+        out = stack_samples([self.transform(d) for d in flat])
+        return out.reshape(*batch_shape, *out.shape[1:])
+
+
+# Batched counterparts of TorchVisionTransformerComposition.possible_transforms. They operate on
+# (N, C, H, W) tensors and carry a flag marking whether the data is still an image in the PIL
+# sense (before 'torch'), in which case values are kept in the uint8 range.
+def _batch_crop(x: torch.Tensor, shape, is_image: bool):
+    top, left, height, width = shape
+    return x[..., top:top + height, left:left + width], is_image
+
+
+def _batch_resize(x: torch.Tensor, shape, is_image: bool):
+    dtype = x.dtype
+    x = F.interpolate(x.float(), size=tuple(shape[-3:-1]), mode='bilinear', align_corners=False, antialias=True)
+    if is_image and not dtype.is_floating_point:
+        x = x.round().clamp(0, 255).to(dtype)
+    return x, is_image
+
+
+def _batch_to_tensor(x: torch.Tensor, shape, is_image: bool):
+    if x.dtype == torch.uint8:
+        return x.float().div(255.), False
+    return x.float(), False
+
+
+def _batch_float(x: torch.Tensor, shape, is_image: bool):
+    return x.float(), is_image
+
+
+def _batch_normalize(x: torch.Tensor, shape, is_image: bool):
+    return x/255., is_image
+
 
 class TorchVisionTransformerComposition(DataTransformation):
 
     possible_transforms = {
-            'crop': lambda shape: transforms.Lambda(lambda x: transforms.functional.crop(x, *shape)),
+            'crop': lambda shape: transforms.Lambda(lambda x: tv_functional.crop(x, *shape)),
             'reshape': lambda shape: transforms.Resize(shape[-3:-1]),
             'float': lambda _: transforms.Lambda(lambda x: x.float()),
             'torch': lambda _: transforms.ToTensor(),
             'normalize': lambda _: transforms.Lambda(lambda x: x/255.)
             }
 
+    batch_transforms = {
+            'crop': _batch_crop,
+            'reshape': _batch_resize,
+            'float': _batch_float,
+            'torch': _batch_to_tensor,
+            'normalize': _batch_normalize,
+            }
+
     @staticmethod
     def unpack(transform_name_list, shape: Optional[Iterable[int]] = None):
         transforms_list = []
@@ -34,6 +93,8 @@ class TorchVisionTransformerComposition(DataTransformation):
         
     def __init__(self, transform_list: List[str], shape: Optional[Iterable[int]] = None):
         self.transforms = TorchVisionTransformerComposition.unpack(transform_list, shape)
+        self.transform_list = list(transform_list)
+        self.shape = shape
     
     def transform(self, data: Dict[str, Any]):
         img = Image.fromarray(data)
@@ -43,6 +104,31 @@ class TorchVisionTransformerComposition(DataTransformation):
             # print(img.shape)
         return img
 
+    def transform_batch(self, data, batch_ndim: int = 1):
+        """
+        Applies the composition to a (*batch, H, W, C) or grayscale (*batch, H, W) block with
+        tensor ops only. Returns (*batch, C, H, W) once 'torch' has been applied, the input layout
+        otherwise.
+        """
+        x = torch.as_tensor(np.asarray(data))
+        batch_shape = x.shape[:batch_ndim]
+        sample_shape = x.shape[batch_ndim:]
+        grayscale = len(sample_shape) == 2
+        if grayscale:
+            # grayscale, ToTensor adds the channel dimension as well
+            sample_shape = sample_shape + (1,)
+        elif len(sample_shape) != 3:
+            raise ValueError(f'Image samples need shape (H, W) or (H, W, C), got {tuple(sample_shape)}')
+        x = x.reshape(-1, *sample_shape).permute(0, 3, 1, 2)
+        is_image = True
+        for t in self.transform_list:
+            x, is_image = TorchVisionTransformerComposition.batch_transforms[t](x, self.shape, is_image)
+        if is_image:
+            x = x.permute(0, 2, 3, 1)
+            if grayscale:
+                x = x.squeeze(-1)
+        return x.reshape(*batch_shape, *x.shape[1:])
+
 
 class ImageTransformer(DataTransformation):
 
@@ -71,3 +157,6 @@ class TypeTransformer(DataTransformation):
 
     def transform(self, data):
         return self.transformation(data)
+
+    def transform_batch(self, data, batch_ndim: int = 1):
+        return self.transformation(data)
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import shutil
 from typing import Tuple, Any, Type
@@ -7,6 +8,10 @@ from config_parser.config_parser import ConfigGenerator
 import torch
 
 from torch_runner.train.base import AbstractTrainer
+from torch_runner.util.torch_utils import load_model_state
+
+
+CHECKPOINT_PATTERN = re.compile(r'model_(\d{3})')
 
 
 def load_config() -> Tuple[Any, ConfigGenerator]:
@@ -58,7 +63,8 @@ def save_config(config_object: ConfigGenerator, run_path: str, run_number: str):
 
 def setup_run(run_path: str):
     print('Building run directory at ' + run_path)
-    os.makedirs(run_path)
+    # the run directory itself may already have been claimed by allocate_run_number
+    os.makedirs(run_path, exist_ok=True)
     os.mkdir(os.path.join(run_path, 'checkpoints'))
     os.mkdir(os.path.join(run_path, 'data'))
     os.mkdir(os.path.join(run_path, 'results'))
@@ -88,6 +94,22 @@ def find_next_run_number(experiment_path: str):
     return i
 
 
+def allocate_run_number(experiment_dir: str, run_name: str) -> int:
+    """
+    Claims the next free run number by creating its run directory. os.mkdir fails if the
+    directory exists, so concurrent jobs never end up with the same run.
+    """
+    experiment_path = os.path.join(experiment_dir, run_name)
+    os.makedirs(experiment_path, exist_ok=True)
+    run_number = find_next_run_number(experiment_path)
+    while True:
+        try:
+            os.mkdir(get_run_path(experiment_dir, run_name, run_number))
+            return run_number
+        except FileExistsError:
+            run_number += 1
+
+
 def get_run_path(experiment_dir, run_name, run_number):
     path = os.path.join(experiment_dir, run_name)
     path = os.path.join(path, 'run_{:03d}'.format(run_number))
@@ -102,27 +124,28 @@ def setup_experiment(config, config_object: ConfigGenerator, debug: bool = False
         log_dir = config.EXPERIMENT.experiment_dir
         run_name = config.EXPERIMENT.run_name
         overwrite = config.EXPERIMENT.overwrite
-        experiment_path = os.path.join(log_dir, run_name)
+        if getattr(config.EXPERIMENT, 'resume', False):
+            return resume_experiment(config, config_object)
         try:
             setup_new_run = False
             run_number = config.EXPERIMENT.run_number
             if not (overwrite or load_config):
                 print('Given a run_number but not told to overwrite, will setup new experiment')
                 setup_new_run = True
-                run_number = find_next_run_number(experiment_path)
+                run_number = allocate_run_number(log_dir, run_name)
         except AttributeError as e:
             if load_config:
                 print('Cannot load run without run number (default should be set to 0')
                 sys.exit(1)
             setup_new_run = True
-            run_number = find_next_run_number(experiment_path)
+            run_number = allocate_run_number(log_dir, run_name)
         run_path = get_run_path(log_dir, run_name, run_number)
         if load_config:
             if overwrite:
                 print('Cannot overwrite an experiment while reloading it')
                 sys.exit(1)
             config, config_object = load_config_from_file(run_path, run_number)
-            run_number = find_next_run_number(experiment_path)
+            run_number = allocate_run_number(log_dir, run_name)
             run_path = get_run_path(log_dir, run_name, run_number)
             setup_new_run = True
         if setup_new_run:
@@ -135,10 +158,61 @@ def setup_experiment(config, config_object: ConfigGenerator, debug: bool = False
         return config, config_object
 
 
+def resume_experiment(config, config_object: ConfigGenerator):
+    """
+    Continues the run with the configured run number, e.g. after the job was preempted. The run
+    is set up if it does not exist yet, so the same command starts and resumes it.
+    """
+    ex = config.EXPERIMENT
+    run_path = get_run_path(ex.experiment_dir, ex.run_name, ex.run_number)
+    if os.path.exists(os.path.join(run_path, 'config.yml')):
+        print('Resuming run at ' + run_path)
+        return load_config_from_file(run_path, ex.run_number)
+    setup_run(run_path)
+    save_config(config_object, run_path, ex.run_number)
+    return load_config_from_file(run_path, ex.run_number)
+
+
+def get_state_path(config) -> str:
+    ex = config.EXPERIMENT
+    return os.path.join(get_run_path(ex.experiment_dir, ex.run_name, ex.run_number), 'checkpoints', 'training_state.pt')
+
+
+def setup_checkpointing(config, trainer: AbstractTrainer, every_n_steps: int = 0) -> bool:
+    """
+    Saves the full training state of trainer to the run's checkpoints after every epoch and every
+    every_n_steps steps, and restores it if the run already has one. Needs to be called once the
+    trainer is fully set up, returns whether training was resumed.
+    """
+    state_path = get_state_path(config)
+    trainer.configure_checkpointing(state_path, every_n_steps)
+    if not os.path.exists(state_path):
+        return False
+    trainer.load_state(state_path)
+    print(f'Resumed training state from {state_path} at epoch {trainer.epoch}, step {trainer.epoch_step}')
+    return True
+
+
+def find_last_checkpoint(checkpoint_path: str) -> int:
+    numbers = [int(match.group(1)) for match in map(CHECKPOINT_PATTERN.fullmatch, os.listdir(checkpoint_path)) if match]
+    return max(numbers) if numbers else -1
+
+
 def get_model(config, model_class: Type[torch.nn.Module]):
+    """
+    Builds the model from the MODULE config and, if a run is loaded, restores a checkpoint from
+    memory mapped tensors. EXPERIMENT.meta_init constructs the model on the meta device instead of
+    initializing weights which are overwritten anyway, EXPERIMENT.load_modules restricts loading to
+    the listed submodules.
+    """
     model_config = config.MODULE
-    model = model_class(**model_config._asdict())
     ex = config.EXPERIMENT
+    meta_init = ex.load_run and getattr(ex, 'meta_init', False) and not getattr(ex, 'load_modules', [])
+    if meta_init:
+        with torch.device('meta'):
+            model = model_class(**model_config._asdict())
+    else:
+        model = model_class(**model_config._asdict())
     if ex.load_run:
         path = get_run_path(ex.experiment_dir, ex.run_name, ex.run_number)
         path = os.path.join(path, 'checkpoints')
@@ -149,9 +223,7 @@ def get_model(config, model_class: Type[torch.nn.Module]):
             checkpoint_number = ex.checkpoint_number
         except AttributeError as e:
             print('Did not specify checkpoint number, using last available')
-            checkpoint_number = find_next_run_number(path) - 1
+            checkpoint_number = find_last_checkpoint(path)
         path = os.path.join(path, 'model_{:03d}'.format(checkpoint_number))
-        model_state_dict = torch.load(path)
-        model.load_state_dict(model_state_dict)
+        load_model_state(model, path, list(getattr(ex, 'load_modules', [])))
     return model
-
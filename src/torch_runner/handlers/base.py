@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from enum import Enum
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 
 class HandlerType(Enum):
@@ -14,6 +15,9 @@ class HandlerType(Enum):
 
 class AbstractHandler(ABC):
 
+    # notified on every every_n-th event of its type only, see HandlerRegistry
+    every_n = 1
+
     def __init__(self, callback_type: HandlerType):
         self.callback_type = callback_type
 
@@ -24,6 +28,48 @@ class AbstractHandler(ABC):
     def set_callback_type(self, callback_type: HandlerType):
         self.callback_type = callback_type
 
+    def set_frequency(self, every_n: int):
+        if every_n < 1:
+            raise ValueError(f'Handler frequency needs to be at least 1, got {every_n}')
+        self.every_n = every_n
+
+    def skip(self):
+        """
+        Called by HandlerRegistry instead of notify on the events a handler with every_n > 1
+        skips. Advances the step of handlers which count them, so they keep logging at the step
+        of the event.
+        """
+        if hasattr(self, 'step'):
+            self.step += 1 #type: ignore
+
+    def keys(self) -> Optional[Set[str]]:
+        """
+        The data keys notify reads, None if it reads all of them.
+        """
+        return None
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        What needs to be restored to resume logging, by default the step count of handlers which
+        have one.
+        """
+        if hasattr(self, 'step'):
+            return {'step': self.step} #type: ignore
+        return {}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def flush(self):
+        """
+        Called at the end of training, handlers doing work in the background finish it here.
+        """
+        pass
+
+    def close(self):
+        self.flush()
+
 
 class AbstractStepHandler(AbstractHandler):
     
@@ -48,3 +94,93 @@ class AbstractFinishHandler(AbstractHandler):
     def __init__(self):
         super().__init__(HandlerType.AFTER_TRAIN)
 
+
+
+class HandlerRegistry():
+    """
+    Keeps handlers bucketed by HandlerType together with the data keys each of them reads, so a
+    notification only visits the handlers of its type and passes each of them only its keys.
+    Handlers with every_n > 1 are skipped on all but every every_n-th event of their type.
+    Changes to registered handlers, e.g. to their callback type, need a call to rebuild.
+    """
+
+    def __init__(self):
+        self.handlers: List[AbstractHandler] = []
+        self.buckets: Dict[HandlerType, List[Tuple[AbstractHandler, Optional[Tuple[str, ...]], int]]] = {}
+        self.counts: Dict[HandlerType, int] = {t: 0 for t in HandlerType}
+        self.rebuild()
+
+    def register(self, handler: AbstractHandler):
+        self.handlers.append(handler)
+        self.add_to_bucket(handler)
+
+    def add_to_bucket(self, handler: AbstractHandler):
+        keys = handler.keys()
+        self.buckets[handler.callback_type].append((handler, tuple(keys) if keys is not None else None, handler.every_n))
+
+    def rebuild(self):
+        self.buckets = {t: [] for t in HandlerType}
+        for handler in self.handlers:
+            self.add_to_bucket(handler)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {'handlers': [handler.state_dict() for handler in self.handlers],
+                'counts': {t.name: count for t, count in self.counts.items()}}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """
+        Handlers are matched by registration order, so they need to be registered the same way
+        as in the run the state was saved from.
+        """
+        if len(state['handlers']) != len(self.handlers):
+            raise ValueError(f'State has {len(state["handlers"])} handlers, {len(self.handlers)} are registered')
+        for handler, handler_state in zip(self.handlers, state['handlers']):
+            handler.load_state_dict(handler_state)
+        self.counts = {t: state['counts'].get(t.name, 0) for t in HandlerType}
+
+    def has_handlers(self, notify_type: HandlerType) -> bool:
+        return len(self.buckets[notify_type]) > 0
+
+    def notify(self, data: Dict[str, Any], notify_type: HandlerType):
+        bucket = self.buckets[notify_type]
+        if not bucket:
+            return
+        count = self.counts[notify_type]
+        self.counts[notify_type] = count + 1
+        for handler, keys, every_n in bucket:
+            if count % every_n != 0:
+                handler.skip()
+                continue
+            if keys is None:
+                handler.notify(data)
+            else:
+                handler.notify({k: data[k] for k in keys if k in data})
+
+    def mark(self, notify_type: HandlerType) -> Tuple[int, List[Optional[int]]]:
+        """
+        Records the position of the next event of notify_type, so notify_at can deliver data to
+        it once that event has passed, e.g. the results of an asynchronous evaluation.
+        """
+        return self.counts[notify_type], [getattr(handler, 'step', None) for handler, _, _ in self.buckets[notify_type]]
+
+    def notify_at(self, data: Dict[str, Any], notify_type: HandlerType, mark: Tuple[int, List[Optional[int]]]):
+        """
+        Notifies the handlers of notify_type which were notified at the marked event, with the
+        step they had then. Counts and steps are left as they are, so late data does not shift
+        the steps or every_n phases of later events.
+        """
+        count, steps = mark
+        for (handler, keys, every_n), step in zip(self.buckets[notify_type], steps):
+            if count % every_n != 0:
+                continue
+            current = getattr(handler, 'step', None)
+            if step is not None:
+                handler.step = step #type: ignore
+            try:
+                if keys is None:
+                    handler.notify(data)
+                else:
+                    handler.notify({k: data[k] for k in keys if k in data})
+            finally:
+                if step is not None:
+                    handler.step = current #type: ignore
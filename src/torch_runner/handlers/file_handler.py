@@ -1,39 +1,134 @@
 import os
 import pickle
+import queue
+import threading
+from collections import deque
 import dill #type: ignore
-from typing import Optional, List, Tuple, Any, Callable, Dict, BinaryIO
+from typing import Optional, List, Tuple, Any, Callable, Dict, BinaryIO, Deque, Set
 
 import torch
 
+from torch_runner.util.reduction import RunningReduction
+from torch_runner.util.step_log import StepLogWriter
 from .base import AbstractHandler, AbstractEpochHandler, AbstractStepHandler
 
 
-def wrap_file_open(data: Dict, file_name: str, function: Callable[[Any, BinaryIO], None]):
+def wrap_file_open(data: Dict, file_name: str, function: Callable[[Any, BinaryIO], None], fsync: bool = False):
     """
-    Helper function to allow a lambda wrappig of saving functions which require opening file wrappers
+    Helper function to allow a lambda wrappig of saving functions which require opening file wrappers.
+    The data is written to a temporary file which is renamed, so file_name is either complete or
+    not there at all. With fsync, the file and its directory are synced to disk as well, so it also
+    survives a crash of the machine.
     """
-    with open(file_name, 'wb') as f:
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
         function(data, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_name, file_name)
+    if not fsync:
+        return
+    dir_fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def snapshot(data: Any) -> Any:
+    """
+    Copies all tensors in (nested) data to the cpu, so training can continue to modify them.
+    """
+    if isinstance(data, torch.Tensor):
+        return data.detach().to('cpu', copy=True)
+    if isinstance(data, dict):
+        return type(data)((k, snapshot(v)) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return type(data)(snapshot(v) for v in data)
+    return data
+
+
+class AsyncFileWriter():
+    """
+    Runs file writing jobs in order on a background thread. The queue is bounded, so put blocks
+    once max_queue_size snapshots are waiting. Errors are raised on the next put or flush.
+    """
+
+    def __init__(self, max_queue_size: int = 2):
+        self.queue: queue.Queue = queue.Queue(max_queue_size)
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def put(self, job: Callable[[], None]):
+        self.raise_error()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put(job)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
 
 
 class FileHandler(AbstractHandler):
     
-    SUPPORTED = ['pickle', 'torch']
+    SUPPORTED = ['pickle', 'torch', 'steplog']
     
     @staticmethod
-    def setup_compression(method):
+    def setup_compression(method, fsync: bool = False):
         if method == 'pickle':
-            return lambda data, file_name: wrap_file_open(data.detach().cpu(), file_name, pickle.dump)
+            return lambda data, file_name: wrap_file_open(data.detach().cpu(), file_name, pickle.dump, fsync)
         if method == 'torch':
-            return torch.save
+            return lambda data, file_name: wrap_file_open(data, file_name, torch.save, fsync)
+        # 'steplog' appends to a StepLogWriter instead of writing files per step
+        return None
     
-    def __init__(self, log_dir: str, compression_method:str='pickle', log_name_list: Optional[List[str]]=None):
+    def __init__(self, log_dir: str, compression_method:str='pickle', log_name_list: Optional[List[str]]=None,
+            async_writing: bool=False, max_queue_size: int=2, keep_last: Optional[int]=None, fsync: Optional[bool]=None):
+        """
+        With async_writing, data is snapshotted to the cpu and written by a background thread.
+        keep_last removes all but the newest keep_last files of every key. The 'steplog' method
+        appends all steps of a key to a single file, see torch_runner.util.step_log. Files are
+        always replaced atomically, fsync additionally syncs them to disk and defaults to
+        async_writing, where it does not hold up training.
+        """
         if compression_method not in FileHandler.SUPPORTED:
             raise NotImplementedError('Currently only supports the following compression methods: ' + ' ,'.join(FileHandler.SUPPORTED))
         self.log_dir = log_dir
-        self.saving = FileHandler.setup_compression(compression_method)
+        self.saving = FileHandler.setup_compression(compression_method, async_writing if fsync is None else fsync)
         self.step = 0
         self.log_name_list = log_name_list
+        self.writer = AsyncFileWriter(max_queue_size) if async_writing else None
+        self.keep_last = keep_last
+        self.written: Dict[str, Deque[str]] = {}
+        self.step_log = StepLogWriter(log_dir) if compression_method == 'steplog' else None
         super().__init__() #type: ignore
 
     def register_logging(self, log_key: str):
@@ -42,31 +137,84 @@ class FileHandler(AbstractHandler):
         else:
             self.log_name_list.append(log_key)
 
+    def keys(self) -> Optional[Set[str]]:
+        if self.log_name_list is None:
+            return None
+        return set(self.log_name_list) | {'step'}
+
+    def select(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in data.items() if (self.log_name_list is None) or (key in self.log_name_list)}
+
     def notify(self, data):
         if 'step' in data:
             self.step += data['step']
         else:
             self.step += 1
+        self.write(self.select(data))
+
+    def write(self, data: Dict[str, Any]):
+        """Saves every entry of data at the current step, without filtering."""
         for key in data:
-            if (self.log_name_list is not None) and (key not in self.log_name_list):
-                continue
-            full_path = os.path.join(self.log_dir, '{}_{:07d}.save'.format(key, self.step))
-            self.saving(data[key], full_path)
+            if self.writer is not None:
+                self.writer.put(lambda key=key, step=self.step, datum=snapshot(data[key]): self.save(key, step, datum))
+            else:
+                self.save(key, self.step, data[key])
+
+    def save(self, key: str, step: int, data: Any):
+        if self.step_log is not None:
+            self.step_log.append(key, step, data)
+            return
+        full_path = os.path.join(self.log_dir, '{}_{:07d}.save'.format(key, step))
+        self.saving(data, full_path)
+        if self.keep_last is None:
+            return
+        written = self.written.setdefault(key, deque())
+        written.append(full_path)
+        while len(written) > self.keep_last:
+            old_path = written.popleft()
+            if old_path != full_path and os.path.exists(old_path):
+                os.remove(old_path)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+        if self.step_log is not None:
+            self.step_log.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.step_log is not None:
+            self.step_log.close()
 
 
 class ModelSavingHandler(FileHandler):
-    def __init__(self, log_dir: str):
-        super().__init__(log_dir, compression_method='torch', log_name_list=['model_state'])
+    def __init__(self, log_dir: str, async_writing: bool=False, keep_last: Optional[int]=None):
+        super().__init__(log_dir, compression_method='torch', log_name_list=['model_state'],
+                async_writing=async_writing, keep_last=keep_last, fsync=True)
 
 
 class NStepFileHandler(FileHandler, AbstractStepHandler):
-    def __init__(self, n: int, log_dir: str, compression_method:str='pickle', log_name_list: Optional[List[str]]=None):
+    def __init__(self, n: int, log_dir: str, compression_method:str='pickle', log_name_list: Optional[List[str]]=None,
+            statistics: Optional[List[str]]=None, ema_decay: float=0.99):
+        """
+        By default the data of every n-th step is saved. If statistics are given, the data of all
+        steps is reduced on device instead and the RunningReduction results are saved.
+        """
         super().__init__(log_dir, compression_method, log_name_list)
         self.n = n
+        self.reduction = RunningReduction(statistics, ema_decay) if statistics is not None else None
 
     def notify(self, data):
+        if self.reduction is not None:
+            self.reduction.update(self.select(data))
         if self.step > 0 and self.step % self.n == 0:
-            super().notify(data)
+            if self.reduction is not None:
+                # the reduced keys carry statistic suffixes, they are already selected
+                self.write(self.reduction.compute())
+                self.reduction.reset()
+            else:
+                self.write(self.select(data))
         self.step += 1 if 'step' not in data else data['step']
 
 
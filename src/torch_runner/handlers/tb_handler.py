@@ -1,16 +1,105 @@
 from abc import ABC, abstractmethod
 import os, shutil
-from typing import Dict, Any, Optional, List
+import queue
+import threading
+from typing import Dict, Any, Optional, List, Tuple, Set
 
 import torch
 
 from .base import AbstractHandler, AbstractStepHandler, HandlerType
 from torch_runner.util.tf_logger import Logger
+from torch_runner.util.reduction import RunningReduction
+
+
+class AsyncScalarWriter():
+    """
+    Writes scalars reduced on device from a background thread. Queued steps are drained in
+    batches, each batch is moved to the host with a single transfer and written as one summary
+    per step. If the bounded queue is full, new steps are either dropped or block the caller.
+    Errors are raised on the next put or flush.
+    """
+
+    def __init__(self, logger: Logger, max_queue_size: int=1000, drop_when_full: bool=False, max_batch: int=64):
+        self.logger = logger
+        self.queue: queue.Queue = queue.Queue(max_queue_size)
+        self.drop_when_full = drop_when_full
+        self.max_batch = max_batch
+        self.dropped = 0
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, step: int, values: Dict[str, torch.Tensor]):
+        self.raise_error()
+        if self.thread is None:
+            self.start()
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait((step, values))
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put((step, values))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write([item for item in batch if item is not None])
+            except BaseException as e:
+                self.error = e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if any(item is None for item in batch):
+                return
+
+    def write(self, batch: List[Tuple[int, Dict[str, torch.Tensor]]]):
+        tensors = [v for _, values in batch for v in values.values()]
+        if not tensors:
+            return
+        flat = torch.stack([v.to(tensors[0].device) for v in tensors]).cpu().tolist()
+        i = 0
+        for step, values in batch:
+            self.logger.scalars_summary(dict(zip(values.keys(), flat[i:i + len(values)])), step)
+            i += len(values)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+        self.logger.flush()
+        self.raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.logger.flush()
+        self.raise_error()
 
 
 class TensorboardHandler(AbstractHandler):
 
-    def __init__(self, logdir: str='tb_logs', namedir: str='default', log_name_list: Optional[List[str]]=None, reset_logdir: bool=True):
+    def __init__(self, logdir: str='tb_logs', namedir: str='default', log_name_list: Optional[List[str]]=None, reset_logdir: bool=True,
+            async_logging: bool=False, max_queue_size: int=1000, drop_when_full: bool=False):
+        """
+        With async_logging, values are averaged on their device and written by an
+        AsyncScalarWriter, so notify never waits for the device.
+        """
         full_path = os.path.join(os.path.abspath(logdir), namedir)
         self.logger = Logger(full_path)
         print(f'Logging to {full_path}')
@@ -25,6 +114,7 @@ class TensorboardHandler(AbstractHandler):
                     print(e)
         self.step = 0
         self.log_name_list = log_name_list
+        self.async_writer = AsyncScalarWriter(self.logger, max_queue_size, drop_when_full) if async_logging else None
         super().__init__()
 
     def register_logging(self, log_key: str):
@@ -33,18 +123,46 @@ class TensorboardHandler(AbstractHandler):
         else:
             self.log_name_list.append(log_key)
 
+    def keys(self) -> Optional[Set[str]]:
+        if self.log_name_list is None:
+            return None
+        return set(self.log_name_list) | {'step'}
+
+    def select(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return {tag: value for tag, value in data.items() if (self.log_name_list is None) or (tag in self.log_name_list)}
+
     def notify(self, data: Dict[str, Any]):
-        for tag, value in data.items():
-            if (self.log_name_list is not None) and (tag not in self.log_name_list):
-                continue
-            self.logger.scalar_summary(tag, value.detach().cpu().numpy().mean(), self.step)
+        self.write(self.select(data))
         if 'step' in data:
             self.step += data['step']
         self.step += 1
 
+    def write(self, data: Dict[str, Any]):
+        """Logs the mean of every value in data at the current step, without filtering."""
+        if self.async_writer is not None:
+            self.async_writer.put(self.step, {tag: value.detach().float().mean() for tag, value in data.items()})
+        else:
+            for tag, value in data.items():
+                self.logger.scalar_summary(tag, value.detach().cpu().numpy().mean(), self.step)
+
+    def flush(self):
+        if self.async_writer is not None:
+            self.async_writer.flush()
+        else:
+            self.logger.flush()
+
+    def close(self):
+        if self.async_writer is not None:
+            self.async_writer.close()
+        else:
+            self.logger.flush()
+
     def reset(self):
+        self.close()
         self.step = 0
         self.logger = Logger('../logs')
+        if self.async_writer is not None:
+            self.async_writer.logger = self.logger
 
 
 ### Example for extending the step handler
@@ -53,16 +171,61 @@ class StepTbHandler(TensorboardHandler, AbstractStepHandler): pass
 
 ### Example for overwriting the notify method to enable logging only every n steps
 class NStepTbHandler(TensorboardHandler, AbstractStepHandler):
-    def __init__(self, n:int, logdir: str='tb_logs', namedir: str='default', log_name_list: Optional[List[str]]=None, reset_logdir: bool=True):
+    def __init__(self, n:int, logdir: str='tb_logs', namedir: str='default', log_name_list: Optional[List[str]]=None, reset_logdir: bool=True,
+            async_logging: bool=False, max_queue_size: int=1000, drop_when_full: bool=False,
+            statistics: List[str]=['mean'], ema_decay: float=0.99):
+        """
+        Values are accumulated on device every step and only moved to the host every n steps,
+        statistics selects which RunningReduction statistics are logged.
+        """
         self.n = n
-        self.data = []
-        super().__init__(logdir=logdir, namedir=namedir, reset_logdir=reset_logdir, log_name_list=log_name_list)
+        self.reduction = RunningReduction(statistics, ema_decay)
+        super().__init__(logdir=logdir, namedir=namedir, reset_logdir=reset_logdir, log_name_list=log_name_list,
+                async_logging=async_logging, max_queue_size=max_queue_size, drop_when_full=drop_when_full)
 
     def notify(self, data: Dict[str, Any]):
-        self.data.append({k: torch.mean(v.detach().cpu()) for k, v in data.items() if (self.log_name_list is None) or (k in self.log_name_list)})
+        self.reduction.update(self.select(data))
         if self.step % self.n == 0 and self.step > 0:
-            d = {k: torch.mean(torch.stack([dic[k] for dic in self.data], 0)) for k in self.data[0]}
-            super().notify(d)
-            self.data = []
+            # the reduced keys carry statistic suffixes, they are already selected
+            self.write(self.reduction.compute())
+            self.reduction.reset()
+        self.step += 1 if 'step' not in data else data['step']
+
+
+class ParameterHistogramHandler(TensorboardHandler, AbstractStepHandler):
+    """
+    Logs histograms of all model parameters every n notifications. Histograms are computed on
+    the parameters' device and moved to the host in one transfer.
+    """
+    def __init__(self, model: torch.nn.Module, n: int=1, logdir: str='tb_logs', namedir: str='default', bins: int=1000,
+            log_name_list: Optional[List[str]]=None, reset_logdir: bool=False):
+        self.model = model
+        self.n = n
+        self.bins = bins
+        super().__init__(logdir=logdir, namedir=namedir, reset_logdir=reset_logdir, log_name_list=log_name_list)
+
+    def keys(self) -> Optional[Set[str]]:
+        # log_name_list selects parameters here, only the step count is read from the data
+        return {'step'}
+
+    def collect(self) -> Dict[str, torch.Tensor]:
+        return {f'parameters/{name}': p.detach() for name, p in self.model.named_parameters()
+                if (self.log_name_list is None) or (name in self.log_name_list)}
+
+    def notify(self, data: Dict[str, Any]):
+        if self.step % self.n == 0:
+            values = self.collect()
+            if values:
+                self.logger.histograms_summary(values, self.step, self.bins)
         self.step += 1 if 'step' not in data else data['step']
 
+
+class GradientHistogramHandler(ParameterHistogramHandler):
+    """
+    Logs histograms of the gradients of all model parameters. Needs to be notified before the
+    gradients are zeroed, e.g. as a step handler of a train_step using the built in
+    optimization_step, which zeroes them at the start of the next accumulation cycle.
+    """
+    def collect(self) -> Dict[str, torch.Tensor]:
+        return {f'gradients/{name}': p.grad.detach() for name, p in self.model.named_parameters()
+                if p.grad is not None and ((self.log_name_list is None) or (name in self.log_name_list))}
@@ -0,0 +1,210 @@
+import itertools
+import os
+import random
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np #type: ignore
+import torch
+
+from config_parser.config_parser import ConfigGenerator
+
+from torch_runner.experiment_setup import setup_experiment, get_run_path
+from torch_runner.handlers.base import AbstractEpochHandler
+
+
+SearchSpace = Dict[str, Union[List[Any], Tuple[Any, Any]]]
+
+
+class TrialStopped(Exception):
+    """Raised by ReportingHandler to end a trial the scheduler stopped."""
+    pass
+
+
+def to_flag(key: str) -> str:
+    if key.startswith('--'):
+        return key
+    return '--' + key.replace('_', '-')
+
+
+def to_arguments(overrides: Dict[str, Any]) -> List[str]:
+    """
+    Turns {'lr': 0.1, '--batch-size': 32, 'clip_gradient': False} into ConfigGenerator command
+    line arguments.
+    """
+    arguments = []
+    for key, value in overrides.items():
+        flag = to_flag(key)
+        if isinstance(value, bool):
+            arguments.append(flag if value else '--no-' + flag[2:])
+        elif isinstance(value, (list, tuple)):
+            arguments += [flag] + [str(v) for v in value]
+        else:
+            arguments += [flag, str(value)]
+    return arguments
+
+
+def expand_grid(space: SearchSpace) -> List[Dict[str, Any]]:
+    for key, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError(f'Grid search needs a list of values for {key}')
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+
+
+def sample_random(space: SearchSpace, n_trials: int, seed: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Lists are sampled uniformly, (low, high) tuples uniformly from the interval, as integers if
+    both bounds are integers.
+    """
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(n_trials):
+        trial = {}
+        for key, values in space.items():
+            if isinstance(values, list):
+                trial[key] = rng.choice(values)
+            elif isinstance(values[0], int) and isinstance(values[1], int):
+                trial[key] = rng.randint(values[0], values[1])
+            else:
+                trial[key] = rng.uniform(values[0], values[1])
+        trials.append(trial)
+    return trials
+
+
+class AshaScheduler():
+    """
+    Asynchronous successive halving. Rungs are at min_resource * reduction_factor**k epochs
+    below max_resource. A trial reaching a rung is stopped if its metric is not within the best
+    1 / reduction_factor of the values other trials reported at that rung before. The rungs
+    live in a multiprocessing Manager, so the scheduler can be handed to pool workers.
+    """
+
+    def __init__(self, metric: str, max_resource: int, mode: str = 'min', min_resource: int = 1, reduction_factor: int = 3):
+        if mode not in ['min', 'max']:
+            raise ValueError(f'Mode needs to be min or max, got {mode}')
+        self.metric = metric
+        self.mode = mode
+        self.reduction_factor = reduction_factor
+        self.milestones = []
+        resource = min_resource
+        while resource < max_resource:
+            self.milestones.append(resource)
+            resource *= reduction_factor
+        self.manager = Manager()
+        self.rungs = self.manager.dict()
+        self.lock = self.manager.Lock()
+
+    def __getstate__(self):
+        # the manager itself stays in the process running the sweep
+        state = self.__dict__.copy()
+        state['manager'] = None
+        return state
+
+    def report(self, resource: int, value: float) -> bool:
+        """
+        Records value at resource and returns whether the trial should continue.
+        """
+        if resource not in self.milestones:
+            return True
+        with self.lock:
+            recorded = list(self.rungs.get(resource, []))
+            self.rungs[resource] = recorded + [value]
+        if not recorded:
+            return True
+        if self.mode == 'min':
+            return value <= np.percentile(recorded, 100. / self.reduction_factor)
+        return value >= np.percentile(recorded, 100. - 100. / self.reduction_factor)
+
+
+class TrialReporter():
+
+    def __init__(self, scheduler: Optional[AshaScheduler] = None):
+        self.scheduler = scheduler
+        self.history: List[Tuple[int, float]] = []
+
+    def report(self, resource: int, value: float):
+        self.history.append((resource, value))
+        if self.scheduler is not None and not self.scheduler.report(resource, value):
+            raise TrialStopped(f'Stopped after {resource} epochs at {value:.4g}')
+
+
+class ReportingHandler(AbstractEpochHandler):
+    """
+    Reports metric from the epoch info dicts to the sweep, raises TrialStopped out of
+    train() when the scheduler stops the trial. Epoch dicts without metric are not counted.
+    """
+
+    def __init__(self, reporter: TrialReporter, metric: str):
+        self.reporter = reporter
+        self.metric = metric
+        self.epochs = 0
+        super().__init__()
+
+    def keys(self):
+        return {self.metric}
+
+    def notify(self, data):
+        if self.metric not in data:
+            return
+        self.epochs += 1
+        self.reporter.report(self.epochs, float(torch.as_tensor(data[self.metric]).float().mean()))
+
+
+TrialFunction = Callable[[Any, ConfigGenerator, TrialReporter], Any]
+
+
+def run_trial(trial_function: TrialFunction, config_file: str, arguments: List[str],
+        scheduler: Optional[AshaScheduler], n_threads: int) -> Dict[str, Any]:
+    torch.set_num_threads(n_threads)
+    config_object = ConfigGenerator(config_file)
+    config = config_object(arguments)
+    result: Dict[str, Any] = {'arguments': arguments, 'run_path': None}
+    if hasattr(config, 'EXPERIMENT'):
+        config, config_object = setup_experiment(config, config_object)
+        ex = config.EXPERIMENT
+        result['run_path'] = get_run_path(ex.experiment_dir, ex.run_name, ex.run_number)
+    reporter = TrialReporter(scheduler)
+    try:
+        result['result'] = trial_function(config, config_object, reporter)
+        result['status'] = 'completed'
+    except TrialStopped as e:
+        print(e)
+        result['status'] = 'stopped'
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['history'] = reporter.history
+    return result
+
+
+def run_sweep(trial_function: TrialFunction, config_file: str, space: SearchSpace, search: str = 'grid',
+        n_trials: int = 10, seed: Optional[int] = None, arguments: List[str] = [],
+        scheduler: Optional[AshaScheduler] = None, max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Runs trial_function for every trial of the search space in a process pool, by default with
+    one process per core. Every trial parses config_file with arguments and its overrides, and
+    gets its own run directory from setup_experiment if the config has an EXPERIMENT section.
+    trial_function(config, config_object, reporter) needs to be importable by the workers, it
+    should register ReportingHandler(reporter, metric) for early stopping by the scheduler.
+    """
+    if search == 'grid':
+        trials = expand_grid(space)
+    elif search == 'random':
+        trials = sample_random(space, n_trials, seed)
+    else:
+        raise NotImplementedError(f'Search {search} not available')
+    max_workers = max_workers or os.cpu_count() or 1
+    n_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    results: List[Dict[str, Any]] = [{} for _ in trials]
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(run_trial, trial_function, config_file, list(arguments) + to_arguments(trial), scheduler, n_threads): i
+                for i, trial in enumerate(trials)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = dict(future.result(), trial=i, overrides=trials[i])
+            print(f'Trial {i} {results[i]["status"]}: {trials[i]}')
+    return results
@@ -1,43 +1,99 @@
+import contextlib
+import os
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, List, Type, Any
+from typing import Dict, Optional, List, Type, Any, Iterable, Tuple, Union
 
 from tqdm import tqdm
 import torch
 from torch.utils.data.dataloader import DataLoader
 from torch.optim.optimizer import Optimizer
 
-from torch_runner.handlers.base import HandlerType, AbstractHandler
+from torch_runner.handlers.base import HandlerType, AbstractHandler, HandlerRegistry
 from torch_runner.util.data_util import DataLoaderType
+from torch_runner.train.device import DevicePrefetcher
+from torch_runner.util.torch_utils import compile_module, set_compile_cache, get_rng_state, set_rng_state
+from torch_runner.handlers.file_handler import wrap_file_open
+from torch_runner.train.distributed import is_distributed, get_rank, get_local_rank, all_reduce_info_dict
+from torch_runner.train.evaluation import AsyncEvaluator, can_evaluate_asynchronously
+from torch_runner.train.profiler import StepProfiler
+
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+    }
+
+
+def make_grad_scaler(device_type: str, enabled: bool):
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
 
 
 class AbstractTrainer(ABC):
 
     def __init__(self, model: Optional[torch.nn.Module] = None):
-        self.handlers: List[AbstractHandler] = []
+        self.handler_registry = HandlerRegistry()
+        self.handlers: List[AbstractHandler] = self.handler_registry.handlers
         self.model = model
         self.scheduler = None
+        self.device: Optional[torch.device] = None
+        self.clip_gradient = False
+        self.clip_gradient_value: Optional[float] = None
+        self.configure_optimization()
+        self.compile_pending = False
+        self.compile_time: Optional[float] = None
+        self.rank = 0
+        self.configure_evaluation()
+        self.profiler: Optional[StepProfiler] = None
+        self.epoch = 0
+        self.epoch_step = 0
+        self.global_step = 0
+        self.configure_checkpointing()
 
     # handler registration block
-    def register_handler(self, handler: AbstractHandler):
-        self.handlers.append(handler)
+    def register_handler(self, handler: AbstractHandler, every_n: int = 1):
+        """
+        The handler is notified on every every_n-th event of its callback type.
+        """
+        handler.set_frequency(every_n)
+        self.handler_registry.register(handler)
 
-    def register_step_handler(self, handler: AbstractHandler):
+    def register_step_handler(self, handler: AbstractHandler, every_n: int = 1):
         handler.set_callback_type(HandlerType.AFTER_STEP)
-        self.register_handler(handler)
+        self.register_handler(handler, every_n)
     
-    def register_epoch_handler(self, handler: AbstractHandler):
+    def register_epoch_handler(self, handler: AbstractHandler, every_n: int = 1):
         handler.set_callback_type(HandlerType.AFTER_EPOCH)
-        self.register_handler(handler)
+        self.register_handler(handler, every_n)
 
     def register_train_handler(self, handler: AbstractHandler):
         handler.set_callback_type(HandlerType.AFTER_TRAIN)
         self.register_handler(handler)
 
+    def register_before_step_handler(self, handler: AbstractHandler, every_n: int = 1):
+        handler.set_callback_type(HandlerType.BEFORE_STEP)
+        self.register_handler(handler, every_n)
+
+    def register_before_epoch_handler(self, handler: AbstractHandler, every_n: int = 1):
+        handler.set_callback_type(HandlerType.BEFORE_EPOCH)
+        self.register_handler(handler, every_n)
+
+    def register_before_train_handler(self, handler: AbstractHandler):
+        handler.set_callback_type(HandlerType.BEFORE_TRAIN)
+        self.register_handler(handler)
+
     # Handler notification block
     def notify_handlers(self, data: Dict, notify_type: HandlerType):
-        for handler in self.handlers:
-            if handler.callback_type == notify_type:
-                handler.notify(data)
+        # in distributed training only the first process logs
+        if self.rank != 0:
+            return
+        self.handler_registry.notify(data, notify_type)
+
+    def has_handlers(self, notify_type: HandlerType) -> bool:
+        return self.rank == 0 and self.handler_registry.has_handlers(notify_type)
 
     def notify_step_handlers(self, data: Dict):
         self.notify_handlers(data, HandlerType.AFTER_STEP)
@@ -48,10 +104,77 @@ class AbstractTrainer(ABC):
     def notify_train_handlers(self, data: Dict):
         self.notify_handlers(data, HandlerType.AFTER_TRAIN)
 
+    def flush_handlers(self):
+        if self.rank != 0:
+            return
+        for handler in self.handlers:
+            handler.flush()
+
     # Model and optimizer setting
     def register_model(self, model: torch.nn.Module):
         self.model = model
 
+    def register_device(self, device: Union[str, torch.device]):
+        """
+        Batches from the dataloaders are moved to this device as a whole before train_step. Needs to
+        be called before registering the optimizer, since it moves the model as well.
+        """
+        self.device = torch.device(device)
+        if self.model is not None:
+            self.model.to(self.device)
+
+    def compile_model(self, method: str = 'compile', mode: str = 'default', backend: str = 'inductor', train_step: bool = False,
+            channels_last: bool = False, fallback: str = '', cache_dir: str = '', example_input_shape: List[int] = []):
+        """
+        Compiles the registered model, see torch_runner.util.torch_utils.COMPILE_DEFAULTS for the
+        options. The time spent compiling is reported as compile_time. torch.compile compiles on
+        first use, so there it includes the duration of the first train_step, which is kept out
+        of the step timings.
+        """
+        if self.model is None:
+            raise ValueError('Cannot compile without module')
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last) #type: ignore
+        if cache_dir:
+            set_compile_cache(cache_dir, self.model, {'method': method, 'mode': mode, 'backend': backend, 'train_step': train_step})
+        example_inputs = None
+        if example_input_shape:
+            example_inputs = [torch.randn(*example_input_shape, device=self.device)]
+            if channels_last and len(example_input_shape) == 4:
+                example_inputs = [x.to(memory_format=torch.channels_last) for x in example_inputs]
+        start = time.perf_counter()
+        self.model = compile_module(self.model, method, mode, backend, fallback, example_inputs)
+        if train_step and hasattr(torch, 'compile'):
+            self.train_step = torch.compile(self.train_step, mode=mode, backend=backend) #type: ignore
+        self.compile_time = time.perf_counter() - start
+        self.compile_pending = method == 'compile' or train_step
+        if not self.compile_pending:
+            print(f'Compilation took {self.compile_time:.2f}s')
+
+    def setup_distributed(self):
+        """
+        Wraps the model in DistributedDataParallel, on cuda using the device of the local rank.
+        Needs an initialized process group, see torch_runner.train.distributed, and has to be
+        called before registering the optimizer. Dataloaders built by training_setup are sharded
+        automatically once the process group is initialized.
+        """
+        if not is_distributed():
+            raise ValueError('Cannot setup distributed training without a process group')
+        if self.model is None:
+            raise ValueError('Cannot setup distributed training without module')
+        self.rank = get_rank()
+        device_ids = None
+        if self.device is not None and self.device.type == 'cuda':
+            self.register_device(torch.device('cuda', get_local_rank()))
+            device_ids = [get_local_rank()]
+        self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=device_ids)
+
+    def unwrapped_model(self) -> Optional[torch.nn.Module]:
+        """The registered model without the DistributedDataParallel wrapper, e.g. for saving."""
+        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            return self.model.module
+        return self.model
+
     def register_optimizer(self, optimizer: Type[Optimizer], lr: float, optimizer_params={}):
         if self.model is None:
             raise ValueError('Cannot register optimizer without module')
@@ -62,35 +185,315 @@ class AbstractTrainer(ABC):
         scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=decay_schedule, gamma=decay_rate)
         self.scheduler = scheduler
 
+    def configure_optimization(self, precision: str = 'fp32', accumulation_steps: int = 1):
+        """
+        Sets up the built in optimization step. precision is one of 'fp32', 'bf16' or 'fp16', only
+        fp16 uses a gradient scaler. Needs to be called after register_device.
+        """
+        if precision not in PRECISIONS:
+            raise NotImplementedError(f'Precision {precision} not available')
+        self.precision = precision
+        self.accumulation_steps = accumulation_steps
+        self.accumulated_steps = 0
+        self.scaler = make_grad_scaler(self.device_type(), enabled=precision == 'fp16')
+
+    def device_type(self) -> str:
+        return self.device.type if self.device is not None else 'cpu'
+
+    def autocast(self):
+        """Context manager for the forward pass of train_step, runs it in the configured precision."""
+        return torch.autocast(self.device_type(), dtype=PRECISIONS[self.precision], enabled=self.precision != 'fp32')
+
+    def sync_gradients(self):
+        """
+        Lets DistributedDataParallel all-reduce gradients in the next backward pass only if it
+        completes an accumulation cycle. Like no_sync, this has to be set before the forward pass,
+        so it is done after every backward pass and at the start of training.
+        """
+        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            self.model.require_backward_grad_sync = self.accumulated_steps == self.accumulation_steps - 1
+
+    def optimization_step(self, loss: torch.Tensor) -> bool:
+        """
+        Backpropagates loss and steps the optimizer once every accumulation_steps calls, returns
+        whether it stepped. Gradients are unscaled before they are clipped. They are zeroed at the
+        start of the next accumulation cycle, so step handlers still see them.
+        """
+        if self.accumulated_steps == 0:
+            self.optimizer.zero_grad(set_to_none=True)
+        self.scaler.scale(loss / self.accumulation_steps).backward()
+        self.accumulated_steps += 1
+        if self.accumulated_steps < self.accumulation_steps:
+            self.sync_gradients()
+            return False
+        self.accumulated_steps = 0
+        self.sync_gradients()
+        if self.clip_gradient:
+            self.scaler.unscale_(self.optimizer)
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip_gradient_value) #type: ignore
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        return True
+
+    def configure_evaluation(self, every: int = 1, max_batches: Optional[int] = None, asynchronous: bool = False):
+        """
+        The test loop runs every `every` epochs on at most max_batches batches. If eval_step is
+        overridden, it runs under torch.inference_mode and its results are added to the epoch info
+        dict. With asynchronous, it instead runs in a forked process on a snapshot of the weights
+        and the results are sent to the epoch handlers once they are ready, with the steps of the
+        epoch they evaluate.
+        """
+        self.eval_every = every
+        self.eval_max_batches = max_batches
+        self.async_evaluator: Optional[AsyncEvaluator] = None
+        self.eval_marks: Dict[int, Tuple[int, List[Optional[int]]]] = {}
+        if asynchronous:
+            self.async_evaluator = AsyncEvaluator()
+
+    def enable_profiling(self, synchronize: bool = False, trace_dir: str = '', trace_start: int = 10, trace_steps: int = 5):
+        """
+        Times the phases of every training step, the statistics are added to each epoch info dict,
+        see torch_runner.train.profiler.StepProfiler.
+        """
+        self.profiler = StepProfiler(synchronize, trace_dir, trace_start, trace_steps)
+
+    def profile(self, phase: str):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(phase)
+
+    # Training state
+    def configure_checkpointing(self, path: str = '', every_n_steps: int = 0):
+        """
+        Saves the full training state to path at the end of every epoch, and every every_n_steps
+        steps within epochs if set. Without a path nothing is saved.
+        """
+        self.state_path = path
+        self.checkpoint_every = every_n_steps
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Everything needed to resume training mid-epoch: model, optimizer, scheduler and gradient
+        scaler, accumulated gradients, random number generators, epoch and step counters, the
+        handlers' steps and the shuffling seed of the train sampler.
+        """
+        model = self.unwrapped_model()
+        if model is None:
+            raise ValueError('Cannot save training state without module')
+        state = {
+            'model': model.state_dict(),
+            'optimizer': self.optimizer.state_dict() if hasattr(self, 'optimizer') else None,
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler': self.scaler.state_dict(),
+            'accumulated_steps': self.accumulated_steps,
+            'gradients': [p.grad for p in model.parameters()] if self.accumulated_steps > 0 else None,
+            'epoch': self.epoch,
+            'epoch_step': self.epoch_step,
+            'global_step': self.global_step,
+            'rng': get_rng_state(),
+            'handlers': self.handler_registry.state_dict(),
+            }
+        sampler = self.find_sampler(getattr(self, 'train_dataloader', None), 'skip')
+        if sampler is not None:
+            state['sampler'] = sampler.state_dict()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """
+        Needs the optimizer, scheduler, handlers and train dataloader to be set up as in the run
+        the state was saved from.
+        """
+        model = self.unwrapped_model()
+        if model is None:
+            raise ValueError('Cannot load training state without module')
+        model.load_state_dict(state['model'])
+        if state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        if state['scheduler'] is not None and self.scheduler is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.accumulated_steps = state['accumulated_steps']
+        if state['gradients'] is not None:
+            for p, grad in zip(model.parameters(), state['gradients']):
+                p.grad = grad.to(p.device) if grad is not None else None
+        self.epoch = state['epoch']
+        self.epoch_step = state['epoch_step']
+        self.global_step = state['global_step']
+        set_rng_state(state['rng'])
+        self.handler_registry.load_state_dict(state['handlers'])
+        sampler = self.find_sampler(getattr(self, 'train_dataloader', None), 'skip')
+        if sampler is not None and 'sampler' in state:
+            sampler.load_state_dict(state['sampler'])
+
+    def save_state(self, path: str = ''):
+        """Writes state_dict atomically to path, by default the configured checkpointing path."""
+        if self.rank != 0:
+            return
+        path = path or self.state_path
+        if not path:
+            raise ValueError('No path to save the training state to')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        wrap_file_open(self.state_dict(), path, torch.save, fsync=True)
+
+    def load_state(self, path: str):
+        self.load_state_dict(torch.load(path, map_location='cpu', weights_only=True))
+
     def add_train_dataloader(self, dataloader: DataLoader):
         self.train_dataloader = dataloader
     
     def add_test_dataloader(self, dataloader: DataLoader):
         self.test_dataloader = dataloader
 
+    def find_sampler(self, dataloader: Optional[DataLoader], attribute: str) -> Optional[Any]:
+        # samplers may be wrapped, e.g. in a BatchSampler or a ResumableSampler
+        sampler = getattr(dataloader, 'sampler', None)
+        while sampler is not None:
+            if hasattr(sampler, attribute):
+                return sampler
+            sampler = getattr(sampler, 'sampler', None)
+        return None
+
+    def set_sampler_epoch(self, dataloader: DataLoader, epoch: int):
+        # reshuffles DistributedSamplers and ResumableSamplers
+        sampler = self.find_sampler(dataloader, 'set_epoch')
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+
+    def skip_batches(self, dataloader: DataLoader, n_batches: int):
+        sampler = self.find_sampler(dataloader, 'skip')
+        batch_size = dataloader.batch_size or getattr(dataloader.sampler, 'batch_size', None)
+        if sampler is None or batch_size is None:
+            print('Train dataloader cannot skip batches, restarting the epoch')
+            self.epoch_step = 0
+            return
+        sampler.skip(n_batches * batch_size)
+
+    def device_batches(self, dataloader: DataLoader) -> Iterable:
+        if self.device is None:
+            return dataloader
+        on_transfer = self.profiler.record_transfer if self.profiler is not None else None
+        return DevicePrefetcher(dataloader, self.device, on_transfer)
+
+    def train_batches(self) -> Iterable:
+        batches = self.device_batches(self.train_dataloader)
+        if self.profiler is not None:
+            return self.profiler.iterate(batches)
+        return batches
+
     def train(self, epochs: int, train_only: bool = False, **kwargs):
+        """
+        Trains until epochs epochs are completed in total, so a trainer resumed from a saved
+        state only runs the remaining ones, starting with the rest of an interrupted epoch.
+        """
         training_info_dict: Dict[str, Any] = {}
-        for e in tqdm(range(epochs)):
+        # picks up handlers whose callback type or logged keys changed since registration
+        self.handler_registry.rebuild()
+        self.sync_gradients()
+        if self.profiler is not None:
+            self.profiler.reset()
+            self.profiler.start_trace()
+        if self.has_handlers(HandlerType.BEFORE_TRAIN):
+            self.notify_handlers({'epochs': torch.tensor(epochs)}, HandlerType.BEFORE_TRAIN)
+        for e in tqdm(range(self.epoch, epochs)):
             epoch_info_dict: Dict[str, Any] = {}
-            for d in tqdm(self.train_dataloader):
-                data = self.train_step(d, **kwargs)
-                self.notify_step_handlers(data)
+            eval_info_dict: Dict[str, Any] = {}
+            self.set_sampler_epoch(self.train_dataloader, e)
+            if self.epoch_step > 0:
+                # resumed mid-epoch
+                self.skip_batches(self.train_dataloader, self.epoch_step)
+            if self.has_handlers(HandlerType.BEFORE_EPOCH):
+                self.notify_handlers({'epoch': torch.tensor(e)}, HandlerType.BEFORE_EPOCH)
+            notify_before_step = self.has_handlers(HandlerType.BEFORE_STEP)
+            for d in tqdm(self.train_batches()):
+                if notify_before_step:
+                    self.notify_handlers({'data': d}, HandlerType.BEFORE_STEP)
+                if self.compile_pending:
+                    # timed as compile_time instead of as a step
+                    data = self.compiling_train_step(d, **kwargs)
+                else:
+                    with self.profile('step'):
+                        data = self.train_step(d, **kwargs)
+                with self.profile('handlers'):
+                    self.notify_step_handlers(data)
+                if self.profiler is not None:
+                    self.profiler.trace_step()
                 epoch_info_dict = self.append_epoch_info_dict(epoch_info_dict, data) 
                 training_info_dict = self.append_training_info_dict(training_info_dict, data)
-            if not train_only:
-                for d in self.test_dataloader:
-                    data = self.train_step(d)
-                    self.notify_step_handlers(data)
-                    epoch_info_dict = self.append_epoch_info_dict(epoch_info_dict, data) 
-                    training_info_dict = self.append_training_info_dict(training_info_dict, data)
+                self.epoch_step += 1
+                self.global_step += 1
+                if self.state_path and self.checkpoint_every and self.global_step % self.checkpoint_every == 0:
+                    self.save_state()
+            if not train_only and (e + 1) % self.eval_every == 0:
+                with self.profile('eval'):
+                    if not self.overrides_eval_step():
+                        # previous behaviour, test batches go through train_step and the step handlers
+                        for i, d in enumerate(self.device_batches(self.test_dataloader)):
+                            if self.eval_max_batches is not None and i >= self.eval_max_batches:
+                                break
+                            data = self.train_step(d)
+                            self.notify_step_handlers(data)
+                            epoch_info_dict = self.append_epoch_info_dict(epoch_info_dict, data) 
+                            training_info_dict = self.append_training_info_dict(training_info_dict, data)
+                    elif self.async_evaluator is not None and can_evaluate_asynchronously(self):
+                        self.async_evaluator.submit(self, e, **kwargs)
+                        self.eval_marks[e] = self.handler_registry.mark(HandlerType.AFTER_EPOCH)
+                    else:
+                        eval_info_dict = self.evaluate(e, **kwargs)
             epoch_info_dict = self.compile_epoch_info_dict(epoch_info_dict, e, **kwargs)
+            epoch_info_dict.update(eval_info_dict)
+            if self.profiler is not None:
+                epoch_info_dict.update(self.profiler.summary())
+            epoch_info_dict = all_reduce_info_dict(epoch_info_dict)
             self.notify_epoch_handlers(epoch_info_dict)
+            self.deliver_eval_results()
+            self.epoch += 1
+            self.epoch_step = 0
+            if self.state_path:
+                self.save_state()
+        self.deliver_eval_results(wait=True)
+        if self.profiler is not None:
+            self.profiler.stop_trace()
         training_info_dict = self.compile_training_info_dict(training_info_dict)
         self.notify_train_handlers(training_info_dict)
+        self.flush_handlers()
 
         if self.scheduler is not None:
             self.scheduler.step()
 
+    # Evaluation
+    def overrides_eval_step(self) -> bool:
+        return type(self).eval_step is not AbstractTrainer.eval_step
+
+    def evaluate(self, epoch: int, **kwargs) -> Dict:
+        eval_info_dict: Dict[str, Any] = {}
+        with torch.inference_mode():
+            for i, d in enumerate(self.device_batches(self.test_dataloader)):
+                if self.eval_max_batches is not None and i >= self.eval_max_batches:
+                    break
+                data = self.eval_step(d, **kwargs)
+                eval_info_dict = self.append_eval_info_dict(eval_info_dict, data)
+        return self.compile_eval_info_dict(eval_info_dict, epoch, **kwargs)
+
+    def deliver_eval_results(self, wait: bool = False):
+        """
+        Passes finished asynchronous evaluations to the epoch handlers as part of the notification
+        of the epoch they evaluate, see HandlerRegistry.notify_at.
+        """
+        if self.async_evaluator is None:
+            return
+        for epoch, eval_info_dict in self.async_evaluator.poll(wait):
+            mark = self.eval_marks.pop(epoch)
+            if eval_info_dict is not None:
+                self.handler_registry.notify_at(eval_info_dict, HandlerType.AFTER_EPOCH, mark)
+
+    def compiling_train_step(self, data, **kwargs) -> Dict:
+        start = time.perf_counter()
+        result = self.train_step(data, **kwargs)
+        self.compile_time = (self.compile_time or 0.) + time.perf_counter() - start
+        self.compile_pending = False
+        print(f'Compilation including the first step took {self.compile_time:.2f}s')
+        return result
+
     # Information dictionaries for handlers
     def append_epoch_info_dict(self, epoch_info_dict: Dict, data_dict: Dict) -> Dict:
         return epoch_info_dict
@@ -103,6 +506,12 @@ class AbstractTrainer(ABC):
 
     def compile_training_info_dict(self, training_info_dict: Dict) -> Dict:
         return training_info_dict
+
+    def append_eval_info_dict(self, eval_info_dict: Dict, data_dict: Dict) -> Dict:
+        return eval_info_dict
+
+    def compile_eval_info_dict(self, eval_info_dict: Dict, epoch: int, **kwargs) -> Dict:
+        return eval_info_dict
     
     # the actual training core class
 
@@ -111,6 +520,10 @@ class AbstractTrainer(ABC):
     def train_step(self, data, **kwargs) -> Dict:
         pass
 
+    # Override this for evaluation without gradients, by default test data goes through train_step
+    def eval_step(self, data, **kwargs) -> Dict:
+        return self.train_step(data, **kwargs)
+
     @abstractmethod
     def check_ready(self) -> bool:
         pass
@@ -0,0 +1,81 @@
+import time
+from typing import Any, Callable, Iterator, Optional, Union
+
+import torch
+from torch.utils.data.dataloader import DataLoader
+
+
+def move_to_device(data: Any, device: torch.device, non_blocking: bool = False) -> Any:
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {k: move_to_device(v, device, non_blocking) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(move_to_device(v, device, non_blocking) for v in data)
+    return data
+
+
+def record_stream(data: Any, stream):
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            record_stream(v, stream)
+
+
+class DevicePrefetcher():
+    """
+    Moves whole batches from a DataLoader to the training device. On CUDA the copy of the next
+    batch is issued non-blocking on a side stream while the current batch is processed, which
+    only overlaps if the DataLoader pins memory. On the CPU batches are passed through without
+    any copy. on_transfer is called with the time spent issuing every copy.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: Union[str, torch.device],
+            on_transfer: Optional[Callable[[float], None]] = None):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.on_transfer = on_transfer
+
+    def transfer(self, batch: Any) -> Any:
+        start = time.perf_counter()
+        batch = move_to_device(batch, self.device, non_blocking=True)
+        if self.on_transfer is not None:
+            self.on_transfer(time.perf_counter() - start)
+        return batch
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.device.type == 'cpu':
+            yield from self.dataloader
+        elif self.device.type == 'cuda':
+            yield from self.prefetch_cuda()
+        else:
+            for batch in self.dataloader:
+                yield self.transfer(batch)
+
+    def prefetch_cuda(self) -> Iterator[Any]:
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.dataloader)
+
+        def preload() -> Optional[Any]:
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return self.transfer(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            record_stream(batch, current_stream)
+            next_batch = preload()
+            yield batch
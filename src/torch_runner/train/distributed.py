@@ -0,0 +1,84 @@
+import os
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', get_rank()))
+
+
+def init_distributed(rank: Optional[int] = None, world_size: Optional[int] = None, backend: str = 'gloo',
+        master_addr: str = '127.0.0.1', master_port: int = 29500):
+    """
+    Joins the process group. Without rank and world_size they are read from the environment as
+    set by torchrun, which is how runs spanning several nodes are started.
+    """
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    if rank is None or world_size is None:
+        dist.init_process_group(backend, init_method='env://')
+    else:
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def _run_worker(rank: int, world_size: int, function: Callable, args: Sequence[Any], backend: str,
+        master_addr: str, master_port: int):
+    os.environ['LOCAL_RANK'] = str(rank)
+    init_distributed(rank, world_size, backend, master_addr, master_port)
+    try:
+        function(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(function: Callable, world_size: int, args: Sequence[Any] = (), backend: str = 'gloo',
+        master_addr: str = '127.0.0.1', master_port: int = 29500):
+    """
+    Starts world_size processes on this machine, each calling function(rank, world_size, *args)
+    in an initialized process group. function has to be importable, since processes are spawned.
+    """
+    mp.spawn(_run_worker, args=(world_size, function, tuple(args), backend, master_addr, master_port),
+            nprocs=world_size, join=True)
+
+
+def all_reduce_info_dict(info_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Averages all numeric and tensor entries of an info dict over the process group with a single
+    all-reduce. Every rank has to hold the same keys, other entries are kept as they are.
+    """
+    if not is_distributed():
+        return info_dict
+    keys = sorted(k for k, v in info_dict.items() if isinstance(v, (torch.Tensor, int, float)) and not isinstance(v, bool))
+    if not keys:
+        return info_dict
+    device = torch.device('cuda', get_local_rank()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    values = [torch.as_tensor(info_dict[k]).detach() for k in keys]
+    flat = torch.cat([v.to(device, torch.float64).flatten() for v in values])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    reduced = dict(info_dict)
+    i = 0
+    for k, v in zip(keys, values):
+        n = v.numel()
+        value = flat[i:i + n].reshape(v.shape)
+        i += n
+        if isinstance(info_dict[k], torch.Tensor):
+            reduced[k] = value.to(info_dict[k].device, info_dict[k].dtype if info_dict[k].is_floating_point() else torch.float64)
+        else:
+            reduced[k] = value.item()
+    return reduced
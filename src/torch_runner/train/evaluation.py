@@ -0,0 +1,77 @@
+import multiprocessing as mp
+import os
+import pickle
+import traceback
+from multiprocessing.connection import wait as wait_for_processes
+from typing import Any, Dict, List, Optional, Tuple
+
+from torch_runner.handlers.file_handler import snapshot
+
+
+def can_evaluate_asynchronously(trainer) -> bool:
+    # the weight snapshot relies on fork, which does not work with cuda or a process group
+    if 'fork' not in mp.get_all_start_methods():
+        return False
+    if trainer.device is not None and trainer.device.type == 'cuda':
+        return False
+    return trainer.rank == 0 and not hasattr(trainer.model, 'module')
+
+
+def _evaluate_in_child(trainer, epoch: int, results, kwargs: Dict[str, Any]):
+    # results are pickled by value, tensors sent through shared memory would not outlive the child
+    status = 0
+    try:
+        results.put(pickle.dumps((epoch, snapshot(trainer.evaluate(epoch, **kwargs)), None)))
+    except BaseException:
+        results.put(pickle.dumps((epoch, None, traceback.format_exc())))
+        status = 1
+    # skip the parent's exit handlers and open handler threads
+    os._exit(status)
+
+
+class AsyncEvaluator():
+    """
+    Evaluates in forked processes. A fork sees a copy-on-write snapshot of the weights at the time
+    of submit, so training continues while the test loop runs. Results are collected with poll.
+    """
+
+    def __init__(self):
+        self.context = mp.get_context('fork')
+        self.results = self.context.SimpleQueue()
+        self.processes: Dict[int, Any] = {}
+
+    def submit(self, trainer, epoch: int, **kwargs):
+        process = self.context.Process(target=_evaluate_in_child, args=(trainer, epoch, self.results, kwargs))
+        process.start()
+        self.processes[epoch] = process
+
+    def pending(self) -> int:
+        return len(self.processes)
+
+    def poll(self, wait: bool = False) -> List[Tuple[int, Optional[Dict]]]:
+        """
+        Returns the epochs and eval info dicts of all finished evaluations, with wait of all
+        submitted ones. Evaluations finish in any order, so the results are not sorted. Failed
+        evaluations, including processes which died without a result, e.g. by the OOM killer,
+        are returned with None.
+        """
+        collected: List[Tuple[int, Optional[Dict]]] = []
+        while self.processes:
+            # a child puts its result before exiting, so the results of these are in the queue
+            exited = [epoch for epoch, process in self.processes.items() if process.exitcode is not None]
+            while not self.results.empty():
+                epoch, result, error = pickle.loads(self.results.get())
+                if error is not None:
+                    print(f'Evaluation of epoch {epoch} failed:\n{error}')
+                collected.append((epoch, result))
+                self.processes.pop(epoch).join()
+            for epoch in exited:
+                if epoch in self.processes:
+                    process = self.processes.pop(epoch)
+                    process.join()
+                    print(f'Evaluation of epoch {epoch} failed: process exited with code {process.exitcode} without a result')
+                    collected.append((epoch, None))
+            if not wait or not self.processes:
+                break
+            wait_for_processes([process.sentinel for process in self.processes.values()], timeout=1.)
+        return collected
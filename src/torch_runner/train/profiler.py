@@ -0,0 +1,113 @@
+import contextlib
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np #type: ignore
+import torch
+
+
+def batch_size(batch: Any) -> int:
+    if isinstance(batch, torch.Tensor):
+        return batch.shape[0] if batch.dim() > 0 else 1
+    if isinstance(batch, np.ndarray):
+        return batch.shape[0] if batch.ndim > 0 else 1
+    if isinstance(batch, dict) and batch:
+        return batch_size(next(iter(batch.values())))
+    if isinstance(batch, (list, tuple)) and batch:
+        return batch_size(batch[0])
+    return 1
+
+
+class StepProfiler():
+    """
+    Times the phases of AbstractTrainer.train: waiting for data, host to device transfer,
+    train_step, handler notification and evaluation. summary returns the timings of the epoch as
+    'profile/...' info dict entries. With synchronize, cuda is synchronized around every phase
+    for exact device timings. If trace_dir is set, a torch.profiler trace of trace_steps steps is
+    written there, starting after trace_start steps.
+    """
+
+    PHASES = ['data_wait', 'host_to_device', 'step', 'handlers', 'eval']
+
+    def __init__(self, synchronize: bool = False, trace_dir: str = '', trace_start: int = 10, trace_steps: int = 5,
+            percentiles: List[int] = [50, 90, 99]):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.percentiles = percentiles
+        self.trace: Optional[Any] = None
+        self.reset()
+
+    def reset(self):
+        self.timings: Dict[str, List[float]] = {p: [] for p in StepProfiler.PHASES}
+        self.transfer_time = 0.
+        self.samples = 0
+        self.steps = 0
+        self.start = time.perf_counter()
+
+    def now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = self.now()
+        yield
+        self.timings[name].append(self.now() - start)
+
+    def record_transfer(self, seconds: float):
+        self.transfer_time += seconds
+
+    def iterate(self, batches: Iterable) -> Iterator:
+        """Yields from batches, timing how long every batch takes to arrive."""
+        iterator = iter(batches)
+        while True:
+            self.transfer_time = 0.
+            start = self.now()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            elapsed = self.now() - start
+            self.timings['host_to_device'].append(self.transfer_time)
+            self.timings['data_wait'].append(elapsed - self.transfer_time)
+            self.samples += batch_size(batch)
+            self.steps += 1
+            yield batch
+
+    def start_trace(self):
+        if not self.trace_dir:
+            return
+        self.trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=self.trace_start, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                record_shapes=True)
+        self.trace.start()
+
+    def trace_step(self):
+        if self.trace is not None:
+            self.trace.step()
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    def summary(self) -> Dict[str, torch.Tensor]:
+        """Returns the statistics since the last summary and starts a new measurement."""
+        elapsed = time.perf_counter() - self.start
+        stats = {
+                'profile/steps_per_sec': self.steps / elapsed if elapsed > 0 else 0.,
+                'profile/samples_per_sec': self.samples / elapsed if elapsed > 0 else 0.,
+                }
+        for name, timings in self.timings.items():
+            if not timings:
+                continue
+            stats[f'profile/{name}_total'] = float(np.sum(timings))
+            stats[f'profile/{name}_mean'] = float(np.mean(timings))
+            for p, value in zip(self.percentiles, np.percentile(timings, self.percentiles)):
+                stats[f'profile/{name}_p{p}'] = float(value)
+        self.reset()
+        return {k: torch.tensor(v) for k, v in stats.items()}
@@ -1,19 +1,29 @@
 import os
 import sys
-from typing import Tuple, Any, Type, Optional
+import time
+from typing import Tuple, Any, Type, Optional, Dict
 import shutil
 
 import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
 from config_parser.config_parser import ConfigGenerator
 
 from torch_runner.train.base import AbstractTrainer
 from torch_runner.data.base import BasicDataSet
-from torch_runner.util.torch_utils import get_optimizer_from_str
+from torch_runner.data.sampler import ResumableSampler
+from torch_runner.util.torch_utils import get_optimizer_from_str, COMPILE_DEFAULTS
+from torch_runner.train.distributed import is_distributed
 
 
 def setup_trainer(trainer_class: Type[AbstractTrainer], model: torch.nn.Module, training_config, train_data: BasicDataSet, test_data: Optional[BasicDataSet]=None):
     trainer = trainer_class()
     trainer.register_model(model)
+    trainer.register_device(getattr(training_config, 'device', getattr(train_data, 'device', 'cpu')))
+    if hasattr(training_config, 'compile'):
+        trainer.compile_model(**dict(COMPILE_DEFAULTS, **training_config.compile._asdict()))
+    if is_distributed():
+        trainer.setup_distributed()
     
     optimizer = get_optimizer_from_str(training_config.optimizer.optimizer_name)
     if hasattr(training_config.optimizer, 'attributes'):
@@ -27,19 +37,125 @@ def setup_trainer(trainer_class: Type[AbstractTrainer], model: torch.nn.Module,
         trainer.clip_gradient_value = training_config.clip_gradient_value
     else:
         trainer.clip_gradient = False
+    trainer.configure_optimization(
+            getattr(training_config, 'precision', 'fp32'),
+            getattr(training_config, 'gradient_accumulation_steps', 1))
+    if hasattr(training_config, 'evaluation'):
+        trainer.configure_evaluation(**training_config.evaluation._asdict())
+    if hasattr(training_config, 'profiling'):
+        trainer.enable_profiling(**training_config.profiling._asdict())
     setup_train_dataloader(trainer, train_data, training_config)
     if test_data is not None:
         setup_test_dataloader(trainer, test_data, training_config)
     return trainer
 
 
+# defaults for the optional data_loading section of the training config
+DATA_LOADING_DEFAULTS: Dict[str, Any] = {
+    'num_workers': 0, # an int or 'auto' to pick the fastest of autotune_workers
+    'prefetch_factor': 2,
+    'persistent_workers': False,
+    'pin_memory': False,
+    'drop_last': False,
+    'sampler': '', # 'random' or 'sequential', defaults to random for training and sequential for testing
+    'batched_fetch': None, # None keeps the dataset's default, on for BasicDataSet and streams, off for sequence datasets
+    'resumable': True, # deterministic shuffling per epoch, so a checkpointed epoch can be resumed
+    'autotune_workers': [0, 2, 4, 8],
+    'autotune_batches': 20,
+    }
+
+SAMPLERS = {
+    'random': RandomSampler,
+    'sequential': SequentialSampler,
+    }
+
+
+def get_data_loading_config(config, device: Optional[torch.device] = None) -> Dict[str, Any]:
+    options = dict(DATA_LOADING_DEFAULTS)
+    # pinned batches let the trainer copy to the gpu asynchronously
+    options['pin_memory'] = device is not None and device.type == 'cuda'
+    if hasattr(config, 'data_loading'):
+        options.update(config.data_loading._asdict())
+    return options
+
+
+def build_dataloader(dataset: BasicDataSet, batch_size: int, shuffle: bool, options: Optional[Dict[str, Any]] = None) -> DataLoader:
+    options = dict(DATA_LOADING_DEFAULTS, **(options or {}))
+    if isinstance(dataset, IterableDataset):
+        return build_stream_dataloader(dataset, batch_size, options)
+    sampler_name = options['sampler'] or ('random' if shuffle else 'sequential')
+    if sampler_name not in SAMPLERS:
+        raise NotImplementedError(f'Sampler {sampler_name} not available')
+    if is_distributed():
+        # every process gets its own shard of the dataset
+        sampler = DistributedSampler(dataset, shuffle=sampler_name == 'random', drop_last=options['drop_last'])
+    else:
+        sampler = SAMPLERS[sampler_name](dataset)
+    if options['resumable']:
+        sampler = ResumableSampler(sampler)
+    num_workers = options['num_workers']
+    loader_args: Dict[str, Any] = {'num_workers': num_workers, 'pin_memory': options['pin_memory']}
+    if num_workers > 0:
+        loader_args['prefetch_factor'] = options['prefetch_factor']
+        loader_args['persistent_workers'] = options['persistent_workers']
+    # datasets with a batched fetch path get whole index batches and return collated batches
+    if options['batched_fetch'] is not None and hasattr(dataset, 'batched_fetch'):
+        dataset.batched_fetch = options['batched_fetch']
+    if getattr(dataset, 'batched_fetch', False):
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=options['drop_last'])
+        return DataLoader(dataset, batch_size=None, sampler=batch_sampler, **loader_args)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=options['drop_last'], **loader_args)
+
+
+def build_stream_dataloader(dataset: IterableDataset, batch_size: int, options: Dict[str, Any]) -> DataLoader:
+    """
+    Streams have no indices, so there is no sampler. They shard themselves between workers and
+    processes and shuffle with their own buffer.
+    """
+    num_workers = options['num_workers']
+    loader_args: Dict[str, Any] = {'num_workers': num_workers, 'pin_memory': options['pin_memory']}
+    if num_workers > 0:
+        loader_args['prefetch_factor'] = options['prefetch_factor']
+        loader_args['persistent_workers'] = options['persistent_workers']
+    if options['batched_fetch'] is not False and hasattr(dataset, 'batched'):
+        return DataLoader(dataset.batched(batch_size, options['drop_last']), batch_size=None, **loader_args)
+    return DataLoader(dataset, batch_size=batch_size, drop_last=options['drop_last'], **loader_args)
+
+
+def autotune_num_workers(dataset: BasicDataSet, batch_size: int, shuffle: bool, options: Dict[str, Any]) -> int:
+    """
+    Times autotune_batches batches for every worker count in autotune_workers and returns the
+    fastest. The first batch of every run is excluded to leave out worker startup.
+    """
+    timings = {}
+    for num_workers in options['autotune_workers']:
+        dataloader = build_dataloader(dataset, batch_size, shuffle, dict(options, num_workers=num_workers, persistent_workers=False))
+        iterator = iter(dataloader)
+        next(iterator, None)
+        start = time.perf_counter()
+        for _, _ in zip(range(options['autotune_batches']), iterator):
+            pass
+        timings[num_workers] = time.perf_counter() - start
+        del iterator
+    best = min(timings, key=lambda n: timings[n])
+    print('Autotuned num_workers to {} ({})'.format(best, ', '.join(f'{n}: {t:.3f}s' for n, t in timings.items())))
+    return best
+
+
+def setup_dataloader(dataset: BasicDataSet, config, shuffle: bool, device: Optional[torch.device] = None) -> DataLoader:
+    options = get_data_loading_config(config, device)
+    if options['num_workers'] == 'auto':
+        options['num_workers'] = autotune_num_workers(dataset, config.batch_size, shuffle, options)
+    return build_dataloader(dataset, config.batch_size, shuffle, options)
+
+
 def setup_train_dataloader(trainer, dataset: BasicDataSet, config, shuffle: bool=True):
-    dataloader = torch.utils.data.dataloader.DataLoader(dataset, batch_size=config.batch_size, shuffle=shuffle)
+    dataloader = setup_dataloader(dataset, config, shuffle, trainer.device)
     trainer.add_train_dataloader(dataloader)
 
 
-def setup_test_dataloader(trainer, dataset: BasicDataSet, config, shuffle: bool=True):
-    dataloader = torch.utils.data.dataloader.DataLoader(dataset, batch_size=config.batch_size, shuffle=shuffle)
+def setup_test_dataloader(trainer, dataset: BasicDataSet, config, shuffle: bool=False):
+    dataloader = setup_dataloader(dataset, config, shuffle, trainer.device)
     trainer.add_test_dataloader(dataloader)
 
 
@@ -0,0 +1,173 @@
+"""
+Minimal writer for tensorboard event files, without depending on tensorflow or protobuf.
+
+Events are framed as TFRecords (length, masked crc32c of the length, payload, masked crc32c of
+the payload) and the few protobuf messages needed for scalar, image and histogram summaries are
+encoded by hand.
+"""
+import itertools
+import os
+import socket
+import struct
+import time
+from typing import List, Optional, BinaryIO
+
+import numpy as np #type: ignore
+
+
+def _make_crc32c_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data: bytes) -> int:
+    crc = 0xffffffff
+    table = _CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+try:
+    # use the C implementation when it is installed, large image summaries are slow otherwise
+    from crc32c import crc32c #type: ignore # noqa: F811
+except ImportError:
+    pass
+
+
+def masked_crc32c(data: bytes) -> int:
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def tfrecord(data: bytes) -> bytes:
+    header = struct.pack('<Q', len(data))
+    return b''.join([
+        header,
+        struct.pack('<I', masked_crc32c(header)),
+        data,
+        struct.pack('<I', masked_crc32c(data)),
+        ])
+
+
+# protobuf wire format encoding
+def _varint(value: int) -> bytes:
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def pb_int(field: int, value: int) -> bytes:
+    return _key(field, 0) + _varint(int(value))
+
+
+def pb_double(field: int, value: float) -> bytes:
+    return _key(field, 1) + struct.pack('<d', value)
+
+
+def pb_float(field: int, value: float) -> bytes:
+    return _key(field, 5) + struct.pack('<f', value)
+
+
+def pb_bytes(field: int, value: bytes) -> bytes:
+    return _key(field, 2) + _varint(len(value)) + value
+
+
+def pb_string(field: int, value: str) -> bytes:
+    return pb_bytes(field, value.encode('utf-8'))
+
+
+def pb_packed_doubles(field: int, values) -> bytes:
+    return pb_bytes(field, np.ascontiguousarray(values, dtype='<f8').tobytes())
+
+
+# tensorboard messages, field numbers follow tensorflow/core/framework/summary.proto and
+# tensorflow/core/util/event.proto
+def scalar_value(tag: str, value: float) -> bytes:
+    return pb_string(1, tag) + pb_float(2, value)
+
+
+def image_value(tag: str, encoded_image: bytes, height: int, width: int, colorspace: int) -> bytes:
+    image = pb_int(1, height) + pb_int(2, width) + pb_int(3, colorspace) + pb_bytes(4, encoded_image)
+    return pb_string(1, tag) + pb_bytes(4, image)
+
+
+def histogram_value(tag: str, min: float, max: float, num: int, sum: float, sum_squares: float, bucket_limit, bucket) -> bytes:
+    histo = b''.join([
+        pb_double(1, min),
+        pb_double(2, max),
+        pb_double(3, num),
+        pb_double(4, sum),
+        pb_double(5, sum_squares),
+        pb_packed_doubles(6, bucket_limit),
+        pb_packed_doubles(7, bucket),
+        ])
+    return pb_string(1, tag) + pb_bytes(5, histo)
+
+
+def summary(values: List[bytes]) -> bytes:
+    return b''.join(pb_bytes(1, v) for v in values)
+
+
+def event(step: int, summary_bytes: Optional[bytes] = None, file_version: Optional[str] = None) -> bytes:
+    out = pb_double(1, time.time()) + pb_int(2, step)
+    if file_version is not None:
+        out += pb_string(3, file_version)
+    if summary_bytes is not None:
+        out += pb_bytes(5, summary_bytes)
+    return out
+
+
+# distinguishes event files opened by one process within the same second
+_file_counter = itertools.count()
+
+
+class EventFileWriter():
+    """
+    Appends events to a single event file in log_dir. The directory is created immediately, the
+    file itself on the first write.
+    """
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self.file: Optional[BinaryIO] = None
+
+    def open(self):
+        file_name = 'events.out.tfevents.{:010d}.{}.{}.{}'.format(
+                int(time.time()), socket.gethostname(), os.getpid(), next(_file_counter))
+        self.file = open(os.path.join(self.log_dir, file_name), 'wb')
+        self.file.write(tfrecord(event(0, file_version='brain.Event:2')))
+
+    def add_summary(self, summary_bytes: bytes, step: int):
+        if self.file is None:
+            self.open()
+        self.file.write(tfrecord(event(step, summary_bytes)))
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
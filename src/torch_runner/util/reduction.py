@@ -0,0 +1,77 @@
+from typing import Dict, List
+
+import torch
+
+
+class RunningReduction():
+    """
+    Accumulates running statistics of logged tensors on their own device. update costs O(1) per
+    key and never synchronizes with the device, compute moves all statistics to the host in a
+    single transfer. The mean is reported under the original key, every other statistic as
+    '{key}_{statistic}'. The exponential moving average is carried over between resets.
+    """
+
+    STATISTICS = ['mean', 'sum', 'count', 'min', 'max', 'ema']
+
+    def __init__(self, statistics: List[str] = ['mean'], ema_decay: float = 0.99):
+        for s in statistics:
+            if s not in RunningReduction.STATISTICS:
+                raise NotImplementedError(f'Statistic {s} not available')
+        self.statistics = list(statistics)
+        self.ema_decay = ema_decay
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.mins: Dict[str, torch.Tensor] = {}
+        self.maxs: Dict[str, torch.Tensor] = {}
+        self.emas: Dict[str, torch.Tensor] = {}
+        self.counts: Dict[str, int] = {}
+
+    def update(self, data: Dict[str, torch.Tensor]):
+        for k, v in data.items():
+            v = v.detach().float()
+            mean = v.mean()
+            if k not in self.sums:
+                self.sums[k] = torch.zeros_like(mean)
+                self.mins[k] = torch.full_like(mean, float('inf'))
+                self.maxs[k] = torch.full_like(mean, float('-inf'))
+                self.counts[k] = 0
+            self.sums[k] += mean
+            self.counts[k] += 1
+            if 'min' in self.statistics:
+                torch.minimum(self.mins[k], v.min(), out=self.mins[k])
+            if 'max' in self.statistics:
+                torch.maximum(self.maxs[k], v.max(), out=self.maxs[k])
+            if 'ema' in self.statistics:
+                if k not in self.emas:
+                    self.emas[k] = mean.clone()
+                else:
+                    self.emas[k].mul_(self.ema_decay).add_(mean, alpha=1 - self.ema_decay)
+
+    def compute(self) -> Dict[str, torch.Tensor]:
+        keys = [k for k in self.sums if self.counts[k] > 0]
+        if not keys:
+            return {}
+        device = self.sums[keys[0]].device
+        rows = []
+        for k in keys:
+            count = torch.tensor(float(self.counts[k]), device=self.sums[k].device)
+            rows.append(torch.stack([
+                self.sums[k] / count,
+                self.sums[k],
+                count,
+                self.mins[k],
+                self.maxs[k],
+                self.emas.get(k, self.sums[k] / count),
+                ]).to(device))
+        host = torch.stack(rows).cpu()
+        result = {}
+        for k, row in zip(keys, host):
+            for s in self.statistics:
+                result[k if s == 'mean' else f'{k}_{s}'] = row[RunningReduction.STATISTICS.index(s)]
+        return result
+
+    def reset(self):
+        for k in self.sums:
+            self.sums[k].zero_()
+            self.mins[k].fill_(float('inf'))
+            self.maxs[k].fill_(float('-inf'))
+            self.counts[k] = 0
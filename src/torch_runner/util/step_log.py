@@ -0,0 +1,202 @@
+"""
+Append-only storage for values logged over many steps. Every key gets one data file holding the
+raw values back to back, an index file of (step, offset, nbytes) records and a small json file
+describing dtype and shape, instead of one file per key and step. Once the shape of a key varies,
+the shape of every following record is appended to a .shp file as a json line.
+"""
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np #type: ignore
+import torch
+
+
+INDEX_DTYPE = np.dtype([('step', '<i8'), ('offset', '<i8'), ('nbytes', '<i8')])
+
+
+def key_file_name(log_dir: str, key: str, suffix: str) -> str:
+    return os.path.join(log_dir, key.replace(os.sep, '.') + suffix)
+
+
+def file_size(path: str) -> int:
+    # data and index files only appear with the first flush, a run may have died before it
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def to_array(value: Any) -> np.ndarray:
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    array = np.asarray(value, order='C')
+    if array.dtype.hasobject:
+        raise ValueError(f'Step logs only store numeric arrays, cannot store a {type(value).__name__}')
+    return array
+
+
+class StepLogWriter():
+    """
+    Buffers appended values per key and writes them out once buffer_bytes are reached or on
+    flush, together with changes to the json files. Existing logs in log_dir are appended to.
+    """
+
+    def __init__(self, log_dir: str, buffer_bytes: int = 2**20):
+        self.log_dir = log_dir
+        self.buffer_bytes = buffer_bytes
+        os.makedirs(log_dir, exist_ok=True)
+        self.meta: Dict[str, Dict[str, Any]] = {}
+        self.data_buffers: Dict[str, List[bytes]] = {}
+        self.index_buffers: Dict[str, List[Tuple[int, int, int]]] = {}
+        self.shape_buffers: Dict[str, List[List[int]]] = {}
+        self.sizes: Dict[str, int] = {}
+        self.counts: Dict[str, int] = {}
+        self.meta_changed: Set[str] = set()
+        self.buffered = 0
+
+    def load_meta(self, key: str, value: np.ndarray):
+        meta_file = key_file_name(self.log_dir, key, '.json')
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r') as f:
+                self.meta[key] = json.load(f)
+            self.sizes[key] = file_size(key_file_name(self.log_dir, key, '.bin'))
+            self.counts[key] = file_size(key_file_name(self.log_dir, key, '.idx')) // INDEX_DTYPE.itemsize
+            if self.meta[key].get('variable_from', 0) > self.counts[key]:
+                # the records after the change of shape were lost before their flush
+                self.meta[key]['variable_from'] = self.counts[key]
+                self.meta_changed.add(key)
+        else:
+            self.meta[key] = {'key': key, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+            self.sizes[key] = 0
+            self.counts[key] = 0
+            self.meta_changed.add(key)
+        self.data_buffers[key] = []
+        self.index_buffers[key] = []
+        self.shape_buffers[key] = []
+
+    def write_meta(self, key: str):
+        with open(key_file_name(self.log_dir, key, '.json'), 'w') as f:
+            json.dump(self.meta[key], f)
+
+    def append(self, key: str, step: int, value: Any):
+        value = to_array(value)
+        if key not in self.meta:
+            self.load_meta(key, value)
+        meta = self.meta[key]
+        if value.dtype.str != meta['dtype']:
+            value = value.astype(meta['dtype'])
+        if meta['shape'] is not None and list(value.shape) != meta['shape']:
+            # values of varying shape can only be read one by one, earlier records keep fixed_shape
+            meta['fixed_shape'] = meta['shape']
+            meta['variable_from'] = self.counts[key]
+            meta['shape'] = None
+            self.meta_changed.add(key)
+        if meta['shape'] is None:
+            self.shape_buffers[key].append(list(value.shape))
+        data = value.tobytes()
+        self.data_buffers[key].append(data)
+        self.index_buffers[key].append((step, self.sizes[key], len(data)))
+        self.sizes[key] += len(data)
+        self.counts[key] += 1
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        for key in self.data_buffers:
+            if not self.index_buffers[key]:
+                continue
+            if key in self.meta_changed:
+                self.write_meta(key)
+                self.meta_changed.discard(key)
+            with open(key_file_name(self.log_dir, key, '.bin'), 'ab') as f:
+                f.write(b''.join(self.data_buffers[key]))
+            with open(key_file_name(self.log_dir, key, '.idx'), 'ab') as f:
+                f.write(np.array(self.index_buffers[key], dtype=INDEX_DTYPE).tobytes())
+            if self.shape_buffers[key]:
+                with open(key_file_name(self.log_dir, key, '.shp'), 'a') as f:
+                    f.write(''.join(json.dumps(shape) + '\n' for shape in self.shape_buffers[key]))
+            self.data_buffers[key] = []
+            self.index_buffers[key] = []
+            self.shape_buffers[key] = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+class StepLogReader():
+    """
+    Reads logs written by StepLogWriter. Keys with values of a fixed shape are read in one
+    vectorized, memory-mapped read, single entries can be accessed or streamed as well.
+    """
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        self.meta: Dict[str, Dict[str, Any]] = {}
+        for file_name in sorted(os.listdir(log_dir)):
+            if file_name.endswith('.json'):
+                with open(os.path.join(log_dir, file_name), 'r') as f:
+                    meta = json.load(f)
+                self.meta[meta['key']] = meta
+
+    def keys(self) -> List[str]:
+        return list(self.meta.keys())
+
+    def index(self, key: str) -> np.ndarray:
+        index_file = key_file_name(self.log_dir, key, '.idx')
+        if not os.path.exists(index_file):
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.fromfile(index_file, dtype=INDEX_DTYPE)
+
+    def steps(self, key: str) -> np.ndarray:
+        return self.index(key)['step']
+
+    def data(self, key: str) -> np.memmap:
+        return np.memmap(key_file_name(self.log_dir, key, '.bin'), dtype=np.uint8, mode='r')
+
+    def read(self, key: str) -> Tuple[np.ndarray, Union[np.ndarray, List[np.ndarray]]]:
+        """Returns all steps of key and the values, stacked into one array if their shape is fixed."""
+        meta = self.meta[key]
+        index = self.index(key)
+        if meta['shape'] is None:
+            return index['step'], list(self.iterate_values(key, index))
+        dtype = np.dtype(meta['dtype'])
+        if len(index) == 0:
+            return index['step'], np.zeros([0] + meta['shape'], dtype=dtype)
+        values = np.memmap(key_file_name(self.log_dir, key, '.bin'), dtype=dtype, mode='r',
+                shape=tuple([len(index)] + meta['shape']))
+        return index['step'], values
+
+    def shapes(self, key: str, n: int) -> List[Optional[List[int]]]:
+        """Shapes of the first n records of key, None for flat logs of older versions."""
+        meta = self.meta[key]
+        if meta['shape'] is not None:
+            return [meta['shape']] * n
+        if 'variable_from' not in meta:
+            return [None] * n
+        shapes = [meta['fixed_shape']] * meta['variable_from']
+        shape_file = key_file_name(self.log_dir, key, '.shp')
+        if os.path.exists(shape_file):
+            with open(shape_file, 'r') as f:
+                shapes += [json.loads(line) for line in f]
+        return shapes[:n]
+
+    def get(self, key: str, i: int) -> Tuple[int, np.ndarray]:
+        index = self.index(key)
+        step, offset, nbytes = index[i]
+        shape = self.shapes(key, len(index))[i]
+        return int(step), self.decode(key, self.data(key)[offset:offset + nbytes], shape)
+
+    def iterate(self, key: str) -> Iterator[Tuple[int, np.ndarray]]:
+        index = self.index(key)
+        return zip((int(s) for s in index['step']), self.iterate_values(key, index))
+
+    def iterate_values(self, key: str, index: np.ndarray) -> Iterator[np.ndarray]:
+        if len(index) == 0:
+            return
+        data = self.data(key)
+        for (_, offset, nbytes), shape in zip(index, self.shapes(key, len(index))):
+            yield self.decode(key, data[offset:offset + nbytes], shape)
+
+    def decode(self, key: str, raw: np.ndarray, shape: Optional[List[int]]) -> np.ndarray:
+        value = raw.view(np.dtype(self.meta[key]['dtype']))
+        return value.reshape(shape) if shape is not None else value
@@ -1,67 +1,134 @@
 # Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
+# Event files are written by torch_runner.util.event_writer, tensorflow is not required
 from io import BytesIO
-import tensorflow as tf #type: ignore
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Union
 import numpy as np #type: ignore
-import scipy.misc #type: ignore
+import torch
+
+from torch_runner.util import event_writer
+
+
+Values = Union[np.ndarray, torch.Tensor]
+
+
+def encode_png(img: np.ndarray) -> bytes:
+    """Encodes an image as png, non uint8 images are rescaled to their value range first."""
+    from PIL import Image #type: ignore
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        low, high = float(img.min()), float(img.max())
+        scale = 255. / (high - low) if high > low else 0.
+        img = ((img - low) * scale).round().astype(np.uint8)
+    if img.ndim == 3 and img.shape[-1] == 1:
+        img = img[..., 0]
+    s = BytesIO()
+    Image.fromarray(img).save(s, format="png")
+    return s.getvalue()
+
+
+def to_image_array(images: Values) -> np.ndarray:
+    """Converts a batch of images to numpy, torch tensors are expected as (N, C, H, W)."""
+    if isinstance(images, torch.Tensor):
+        images = images.detach().cpu()
+        if images.dim() == 4:
+            images = images.permute(0, 2, 3, 1)
+        images = images.numpy()
+    return np.asarray(images)
+
+
+def make_grid(images: np.ndarray, nrow: int, padding: int = 2) -> np.ndarray:
+    """Tiles a (N, H, W[, C]) batch into a single image with nrow images per row."""
+    n, h, w = images.shape[:3]
+    ncol = int(np.ceil(n / nrow))
+    grid = np.zeros((ncol * (h + padding) + padding, nrow * (w + padding) + padding) + images.shape[3:], dtype=images.dtype)
+    for i, img in enumerate(images):
+        row, col = divmod(i, nrow)
+        top, left = padding + row * (h + padding), padding + col * (w + padding)
+        grid[top:top + h, left:left + w] = img
+    return grid
+
+
+def histogram_stats(values: Dict[str, Values], bins: int) -> Dict[str, Dict]:
+    """
+    Computes histograms for several value tensors. Torch tensors are reduced with torch.histc on
+    their own device, and all results are moved to the host in a single transfer.
+    """
+    stats = {}
+    device_stats = []
+    for tag, v in values.items():
+        if isinstance(v, torch.Tensor):
+            v = v.detach().float().flatten()
+            low, high = v.min(), v.max()
+            counts = torch.histc(v, bins=bins, min=0., max=0.)
+            device_stats.append((tag, v.numel(), torch.cat([torch.stack([low, high, v.sum(), (v * v).sum()]), counts])))
+        else:
+            v = np.asarray(v)
+            counts, bin_edges = np.histogram(v, bins=bins)
+            stats[tag] = {'min': float(np.min(v)), 'max': float(np.max(v)), 'num': int(np.prod(v.shape)),
+                    'sum': float(np.sum(v)), 'sum_squares': float(np.sum(v ** 2)),
+                    'bucket_limit': bin_edges[1:], 'bucket': counts}
+    if device_stats:
+        device = device_stats[0][2].device
+        host = torch.cat([s.to(device) for _, _, s in device_stats]).cpu().double().numpy()
+        for i, (tag, num, _) in enumerate(device_stats):
+            low, high, total, total_squares = host[i * (bins + 4):i * (bins + 4) + 4]
+            counts = host[i * (bins + 4) + 4:(i + 1) * (bins + 4)]
+            # histc bins the value range, widened by one on each side for constant values
+            edge_low, edge_high = (low - 1, high + 1) if low == high else (low, high)
+            stats[tag] = {'min': float(low), 'max': float(high), 'num': num,
+                    'sum': float(total), 'sum_squares': float(total_squares),
+                    'bucket_limit': np.linspace(edge_low, edge_high, bins + 1)[1:], 'bucket': counts}
+    return {tag: stats[tag] for tag in values}
 
 
 class Logger():
 
     def __init__(self, log_dir: str):
         """Create a summary writer logging to log_dir."""
-        self.writer = tf.compat.v1.summary.FileWriter(log_dir)
+        self.writer = event_writer.EventFileWriter(log_dir)
+        self.pool: Optional[ThreadPoolExecutor] = None
 
     def scalar_summary(self, tag: str, value: np.ndarray, step: int):
         """Log a scalar variable."""
-        summary = tf.compat.v1.Summary(
-            value=[tf.compat.v1.Summary.Value(tag=tag, simple_value=value)])
+        summary = event_writer.summary([event_writer.scalar_value(tag, float(value))])
         self.writer.add_summary(summary, step)
 
-    def image_summary(self, tag: str, images: np.ndarray, step: int):
-        """Log a list of images."""
-
-        img_summaries = []
-        for i, img in enumerate(images):
-            # Write the image to a string
-            s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
-
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(
-                tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
-
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
+    def scalars_summary(self, values: Dict[str, float], step: int):
+        """Log several scalar variables in a single summary."""
+        summary = event_writer.summary(
+            [event_writer.scalar_value(tag, float(value)) for tag, value in values.items()])
         self.writer.add_summary(summary, step)
 
-    def histo_summary(self, tag: str, values: np.ndarray, step: int, bins: int=1000):
-        """Log a histogram of the tensor of values."""
-
-        # Create a histogram using numpy
-        counts, bin_edges = np.histogram(values, bins=bins)
+    def flush(self):
+        self.writer.flush()
 
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values ** 2))
+    def image_summary(self, tag: str, images: Values, step: int, nrow: Optional[int] = None):
+        """Log a list of images, or a single grid of them with nrow images per row."""
+        images = to_image_array(images)
+        if nrow is not None:
+            images = make_grid(images, nrow)[None]
 
-        # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
+        # png encoding releases the GIL, so images are encoded in parallel
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor()
+        encoded = list(self.pool.map(encode_png, images))
 
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
+        img_summaries = []
+        for i, (img, png) in enumerate(zip(images, encoded)):
+            colorspace = img.shape[2] if img.ndim == 3 else 1
+            img_summaries.append(event_writer.image_value(
+                '%s/%d' % (tag, i), png, height=img.shape[0], width=img.shape[1], colorspace=colorspace))
 
         # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
+        self.writer.add_summary(event_writer.summary(img_summaries), step)
+
+    def histo_summary(self, tag: str, values: Values, step: int, bins: int=1000):
+        """Log a histogram of the tensor of values."""
+        self.histograms_summary({tag: values}, step, bins)
+
+    def histograms_summary(self, values: Dict[str, Values], step: int, bins: int=1000):
+        """Log histograms of several tensors in a single summary."""
+        histos = [event_writer.histogram_value(tag, **stats) for tag, stats in histogram_stats(values, bins).items()]
+        self.writer.add_summary(event_writer.summary(histos), step)
         self.writer.flush()
@@ -1,5 +1,11 @@
-from typing import Type
+import hashlib
+import itertools
+import os
+import random
+from typing import Type, Optional, Sequence, Any, Dict, List
 
+import numpy as np #type: ignore
+import torch
 import torch.optim
 
 
@@ -14,3 +20,139 @@ def get_optimizer_from_str(name: str) -> Type[torch.optim.Optimizer]: #type: ign
     else:
         raise NotImplementedError('Unknown optimizer')
     return optim
+
+
+# defaults for the optional compile section of the training config
+COMPILE_DEFAULTS: Dict[str, Any] = {
+    'method': 'compile', # 'compile', 'script' or 'trace'
+    'mode': 'default', # torch.compile mode, e.g. 'reduce-overhead' or 'max-autotune'
+    'backend': 'inductor',
+    'train_step': False, # also compile the trainer's train_step
+    'channels_last': False,
+    'fallback': '', # 'script' or 'trace', used if torch.compile is not available
+    'cache_dir': '', # compiled artifacts are cached per model and config below this directory
+    'example_input_shape': [], # required for tracing
+    }
+
+
+def set_compile_cache(cache_dir: str, model: torch.nn.Module, options: Dict[str, Any]):
+    """
+    Points the inductor cache to a directory keyed on the model structure and compile options, so
+    repeated runs of the same experiment config reuse the compiled artifacts.
+    """
+    key = hashlib.sha1((repr(model) + repr(sorted(options.items()))).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(os.path.abspath(cache_dir), key)
+    os.makedirs(path, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = path
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def compile_module(model: torch.nn.Module, method: str = 'compile', mode: str = 'default', backend: str = 'inductor',
+        fallback: str = '', example_inputs: Optional[Sequence[torch.Tensor]] = None) -> torch.nn.Module:
+    """
+    Compiles model with torch.compile, in place where supported so state dict keys stay the same,
+    or with torch.jit.script/trace. Falls back to fallback if torch.compile is not available.
+    """
+    if method == 'compile':
+        try:
+            if hasattr(model, 'compile'):
+                model.compile(mode=mode, backend=backend)
+                return model
+            return torch.compile(model, mode=mode, backend=backend) #type: ignore
+        except (AttributeError, RuntimeError) as e:
+            if not fallback:
+                raise
+            print(f'torch.compile not available ({e}), falling back to {fallback}')
+            method = fallback
+    if method == 'script':
+        return torch.jit.script(model)
+    if method == 'trace':
+        if example_inputs is None:
+            raise ValueError('Tracing requires example inputs')
+        return torch.jit.trace(model, tuple(example_inputs))
+    raise NotImplementedError(f'Compile method {method} not available')
+
+
+def load_checkpoint(path: str, map_location: Any = 'cpu') -> Dict[str, Any]:
+    """
+    Loads a torch.save checkpoint weights only, with its tensors memory mapped instead of read
+    into memory. Checkpoints in the legacy, non zipfile format are read fully.
+    """
+    try:
+        return torch.load(path, map_location=map_location, weights_only=True, mmap=True)
+    except (RuntimeError, TypeError) as e:
+        # legacy format, or a torch version without mmap support
+        if 'mmap' not in str(e):
+            raise
+        print(f'Cannot memory map {path}, loading it fully')
+        return torch.load(path, map_location=map_location, weights_only=True)
+
+
+def select_prefixes(state_dict: Dict[str, Any], prefixes: List[str]) -> Dict[str, Any]:
+    return {k: v for k, v in state_dict.items() if any(k == p or k.startswith(p + '.') for p in prefixes)}
+
+
+def is_meta(model: torch.nn.Module) -> bool:
+    return any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers()))
+
+
+def load_model_state(model: torch.nn.Module, path: str, prefixes: List[str] = []) -> torch.nn.Module:
+    """
+    Loads the checkpoint at path into model from memory mapped tensors, so the weights are never
+    held twice. A model constructed on the meta device is materialized by assigning the mapped
+    tensors, move it to its device afterwards. With prefixes, only the listed submodules (e.g.
+    'encoder' or 'decoder.layers.0') are loaded and need to be complete in the checkpoint.
+    """
+    state_dict = load_checkpoint(path)
+    meta = is_meta(model)
+    if prefixes:
+        if meta:
+            raise ValueError('Cannot partially load a model on the meta device')
+        model_keys = {k: None for k in model.state_dict()}
+        for prefix in prefixes:
+            if not select_prefixes(model_keys, [prefix]):
+                raise ValueError(f'Model has no submodule {prefix}')
+        state_dict = select_prefixes(state_dict, prefixes)
+        missing = select_prefixes(model_keys, prefixes).keys() - state_dict.keys()
+        if missing:
+            raise ValueError(f'Checkpoint {path} is missing {sorted(missing)}')
+        model.load_state_dict(state_dict, strict=False)
+        return model
+    model.load_state_dict(state_dict, assign=meta)
+    if meta and is_meta(model):
+        raise ValueError(f'Checkpoint {path} did not materialize all tensors, e.g. non persistent buffers')
+    return model
+
+
+def get_rng_state() -> Dict[str, Any]:
+    """
+    States of the python, numpy, torch and cuda random number generators, stored as tensors and
+    plain python types only, so they can be loaded with torch.load(weights_only=True).
+    """
+    numpy_state = np.random.get_state(legacy=False)
+    state = {
+        'python': random.getstate(),
+        'numpy': {'key': torch.from_numpy(numpy_state['state']['key'].astype(np.int64)),
+            'pos': numpy_state['state']['pos'],
+            'has_gauss': numpy_state['has_gauss'],
+            'gauss': numpy_state['gauss']},
+        'torch': torch.get_rng_state(),
+        }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]):
+    random.setstate(state['python'])
+    numpy_state = state['numpy']
+    np.random.set_state({'bit_generator': 'MT19937',
+        'state': {'key': numpy_state['key'].numpy().astype(np.uint32), 'pos': numpy_state['pos']},
+        'has_gauss': numpy_state['has_gauss'], 'gauss': numpy_state['gauss']})
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])